@@ -1,75 +1,767 @@
 #!/usr/bin/env python3
     # -- coding: UTF-8 --
 
-import argparse
 import socket
 import os
 import sys
 import struct
 # from time import time, ctime, sleep
 import time
-from time import time, ctime, sleep
-import random
-import traceback # useful for exception handling
+from time import time, ctime, sleep, strftime, gmtime
 import threading
 import select
-import ipaddress
+import math
+import stat
+import collections
+import itertools
+import bisect
+import atexit
+import signal
+import mmap
+import posixpath
 
-def setupArgumentParser() -> argparse.Namespace:
+
+class LazyModule:
+    # Stands in for a module until one of its attributes is first used, then imports it and takes its place in
+    # the globals, so a short ping or traceroute does not pay for importing what only the servers use. Its own
+    # attributes are private so none of them hides an attribute of the module, like json.load.
+    def __init__(self, name):
+        self._name = name
+
+    def _load(self):
+        # 1. Import the module, __import__ returns the top level package of a dotted name
+        module = __import__(self._name)
+        # 2. Replace this stand in so later uses go straight to the module
+        globals()[self._name.partition('.')[0]] = module
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+
+argparse = LazyModule('argparse')
+random = LazyModule('random')
+traceback = LazyModule('traceback') # useful for exception handling
+queue = LazyModule('queue')
+selectors = LazyModule('selectors')
+ipaddress = LazyModule('ipaddress')
+contextlib = LazyModule('contextlib')
+tempfile = LazyModule('tempfile')
+mimetypes = LazyModule('mimetypes')
+email = LazyModule('email.utils')
+hashlib = LazyModule('hashlib')
+json = LazyModule('json')
+asyncio = LazyModule('asyncio')
+urllib = LazyModule('urllib.parse')
+concurrent = LazyModule('concurrent.futures')
+subprocess = LazyModule('subprocess')
+
+
+def setupArgumentParser(argv=None) -> "argparse.Namespace":
+        # Only the arguments of the sub-command being run are added, all of them when none is named or for --help
+        argv = sys.argv[1:] if argv is None else argv
         parser = argparse.ArgumentParser(
             description='A collection of Network Applications developed for SCC.203.')
-        parser.set_defaults(func=ICMPPing, hostname='www.lancaster.ac.uk')
+        parser.set_defaults(func=ICMPPing, hostname='www.lancaster.ac.uk', count=4, timeout=4, rate=100, interval=1, targets_file=None, metrics_port=None,
+                            summary_interval=0, log_file=None, log_format='csv')
         subparsers = parser.add_subparsers(help='sub-command help')
         
-        parser_p = subparsers.add_parser('ping', aliases=['p'], help='run ping')
-        parser_p.set_defaults(timeout=4)
-        parser_p.add_argument('hostname', type=str, help='host to ping towards')
+        commands = [
+            ('ping', dict(aliases=['p'], help='run ping'), addPingArguments),
+            ('traceroute', dict(aliases=['t'], help='run traceroute'), addTracerouteArguments),
+            ('paris-traceroute', dict(aliases=['pt'], help='run paris-traceroute'), addParisTracerouteArguments),
+            ('web', dict(aliases=['w'], help='run web server'), addWebArguments),
+            ('proxy', dict(aliases=['x'], help='run proxy'), addProxyArguments),
+            ('serve', dict(aliases=['s'], help='run several applications together on one asyncio event loop'), addServeArguments),
+            ('daemon', dict(aliases=['d'], help='run jobs for clients over a Unix socket'), addDaemonArguments),
+            ('client', dict(aliases=['c'], help='run a job in the daemon'), addClientArguments),
+            ('bench', dict(aliases=['b'], help='run benchmarks'), addBenchArguments),
+        ]
+        chosen = [command for command in commands if argv and argv[0] in [command[0]] + command[1]['aliases']]
+        for name, options, addArguments in commands:
+            subparser = subparsers.add_parser(name, **options)
+            if not chosen or chosen[0][0] == name:
+                addArguments(subparser)
+                if chosen:
+                    chosen_parser = subparser
+
+        args = parser.parse_args(argv)
+
+        # Probing needs targets, from the command line or a targets file
+        if chosen and args.func is ICMPPing and not args.hostname and not args.targets_file:
+            chosen_parser.error('no hosts to ping, name at least one or give --targets-file')
+        if chosen and args.func is Traceroute and not args.hostname and not args.targets_file:
+            chosen_parser.error('no hosts to trace, name at least one or give --targets-file')
+        return args
+
+
+def addPingArguments(parser_p):
+        parser_p.set_defaults(timeout=4, count=4, rate=100, interval=1, targets_file=None, metrics_port=None,
+                              summary_interval=0, log_file=None, log_format='csv')
+        parser_p.add_argument('hostname', type=str, nargs='*', help='hosts to ping towards')
         parser_p.add_argument('--count', '-c', nargs='?', type=int,
-                                help='number of times to ping the host before stopping')
+                                help='number of times to ping the host before stopping, 0 to ping until interrupted')
         parser_p.add_argument('--timeout', '-t', nargs='?',
-                                type=int,
+                                type=float,
                                 help='maximum timeout before considering request lost')
+        parser_p.add_argument('--targets-file', '-f', nargs='?', type=str,
+                                help='file with one host per line to ping together with the given hosts')
+        parser_p.add_argument('--rate', '-r', nargs='?', type=float,
+                                help='echo requests sent per second across all hosts')
+        parser_p.add_argument('--interval', '-i', nargs='?', type=float,
+                                help='seconds between two echo requests to the same host')
+        parser_p.add_argument('--metrics-port', nargs='?', type=int,
+                                help='port serving the probe metrics in the Prometheus text format while running')
+        parser_p.add_argument('--summary-interval', '-s', nargs='?', type=float,
+                                help='seconds between two statistics lines per host while running, 0 for none')
+        parser_p.add_argument('--log-file', '-o', nargs='?', type=str,
+                                help='file to append the time, host, sequence number and RTT of every probe to')
+        parser_p.add_argument('--log-format', nargs='?', type=str, choices=['csv', 'binary'],
+                                help='format of the probe log, CSV lines or 18 byte binary records')
         parser_p.set_defaults(func=ICMPPing)
 
-        parser_t = subparsers.add_parser('traceroute', aliases=['t'],
-                                            help='run traceroute')
-        parser_t.set_defaults(timeout=4, protocol='icmp')
-        parser_t.add_argument('hostname', type=str, help='host to traceroute towards')
+
+def addTracerouteArguments(parser_t):
+        parser_t.set_defaults(timeout=4, protocol='icmp', parallel=False, probes=3, max_hops=30, metrics_port=None,
+                              targets_file=None, rate=100, start_ttl=5, concurrency=32)
+        parser_t.add_argument('hostname', type=str, nargs='*', help='hosts to traceroute towards')
         parser_t.add_argument('--timeout', '-t', nargs='?', type=int,
                                 help='maximum timeout before considering request lost')
         parser_t.add_argument('--protocol', '-p', nargs='?', type=str,
                                 help='protocol to send request with (UDP/ICMP)')
+        parser_t.add_argument('--parallel', '-P', action='store_true',
+                                help='send the probes for every hop at once instead of one hop at a time')
+        parser_t.add_argument('--probes', '-q', nargs='?', type=int,
+                                help='number of probes sent per hop in parallel mode')
+        parser_t.add_argument('--max-hops', '-m', nargs='?', type=int,
+                                help='largest ttl probed')
+        parser_t.add_argument('--metrics-port', nargs='?', type=int,
+                                help='port serving the probe metrics in the Prometheus text format while running')
+        parser_t.add_argument('--targets-file', '-f', nargs='?', type=str,
+                                help='file with one host per line to trace in batch mode together with the given hosts')
+        parser_t.add_argument('--rate', '-r', nargs='?', type=float,
+                                help='probes sent per second across all traces in batch mode')
+        parser_t.add_argument('--start-ttl', '-s', nargs='?', type=int,
+                                help='ttl batch mode starts probing forward and backward from')
+        parser_t.add_argument('--concurrency', '-n', nargs='?', type=int,
+                                help='traces in progress at once in batch mode')
         parser_t.set_defaults(func=Traceroute)
-        
-        parser_pt = subparsers.add_parser('paris-traceroute', aliases=['pt'],
-                                            help='run paris-traceroute')
-        parser_pt.set_defaults(timeout=4, protocol='icmp')
+
+
+def addParisTracerouteArguments(parser_pt):
+        parser_pt.set_defaults(timeout=4, protocol='icmp', parallel=False, probes=3, max_hops=30, metrics_port=None,
+                               multipath=False, confidence=95, max_flows=256)
         parser_pt.add_argument('hostname', type=str, help='host to traceroute towards')
         parser_pt.add_argument('--timeout', '-t', nargs='?', type=int,
                                 help='maximum timeout before considering request lost')
         parser_pt.add_argument('--protocol', '-p', nargs='?', type=str,
                                 help='protocol to send request with (UDP/ICMP)')
+        parser_pt.add_argument('--parallel', '-P', action='store_true',
+                                help='send the probes for every hop at once instead of one hop at a time')
+        parser_pt.add_argument('--probes', '-q', nargs='?', type=int,
+                                help='number of probes sent per hop in parallel mode')
+        parser_pt.add_argument('--max-hops', '-m', nargs='?', type=int,
+                                help='largest ttl probed')
+        parser_pt.add_argument('--metrics-port', nargs='?', type=int,
+                                help='port serving the probe metrics in the Prometheus text format while running')
+        parser_pt.add_argument('--multipath', '-M', action='store_true',
+                                help='discover every load balanced path by varying the flow identifier (MDA)')
+        parser_pt.add_argument('--confidence', '-c', nargs='?', type=float,
+                                help='percent confidence that multipath mode found every next hop of every hop')
+        parser_pt.add_argument('--max-flows', nargs='?', type=int,
+                                help='largest number of flow identifiers multipath mode may use')
         parser_pt.set_defaults(func=ParisTraceroute)
 
-        parser_w = subparsers.add_parser('web', aliases=['w'], help='run web server')
+
+def addWebArguments(parser_w):
         parser_w.set_defaults(port=8080)
+        parser_w.set_defaults(concurrency='threads', threads=16, backlog=128, keep_alive_timeout=5, max_requests=100, cache_size=64, root='.',
+                                log_level='warning', access_log=None, workers=1, reuse_port=True, metrics_port=None,
+                                index=False, index_refresh=5)
         parser_w.add_argument('--port', '-p', type=int, nargs='?',
                                 help='port number to start web server listening on')
+        parser_w.add_argument('--concurrency', '-m', nargs='?', type=str,
+                                choices=['serial', 'threads', 'selectors'],
+                                help='how connections are served: one at a time, by a bounded thread pool or by a selectors event loop')
+        parser_w.add_argument('--threads', '-n', nargs='?', type=int,
+                                help='number of worker threads when using the threads concurrency mode')
+        parser_w.add_argument('--backlog', '-b', nargs='?', type=int,
+                                help='maximum number of pending connections queued by the kernel')
+        parser_w.add_argument('--keep-alive-timeout', '-k', nargs='?', type=int,
+                                help='seconds an idle persistent connection is kept open')
+        parser_w.add_argument('--max-requests', '-r', nargs='?', type=int,
+                                help='number of requests served on one connection before it is closed')
+        parser_w.add_argument('--cache-size', '-s', nargs='?', type=int,
+                                help='megabytes of memory used to cache hot files, 0 disables the cache')
+        parser_w.add_argument('--root', '-d', nargs='?', type=str,
+                                help='directory the served files are looked up in')
+        parser_w.add_argument('--index', '-i', action='store_true',
+                                help='scan the root at startup so files are looked up in memory instead of with os.stat')
+        parser_w.add_argument('--index-refresh', nargs='?', type=float,
+                                help='seconds between two scans of the root that pick up changed, new and deleted files')
+        parser_w.add_argument('--log-level', '-l', nargs='?', type=str, choices=list(AccessLog.levels),
+                                help='least severe messages logged, info logs every request')
+        parser_w.add_argument('--access-log', '-a', nargs='?', type=str,
+                                help='file the log is appended to instead of standard output')
+        parser_w.add_argument('--workers', '-w', nargs='?', type=int,
+                                help='number of worker processes serving the port, each with its own threads or event loop')
+        parser_w.add_argument('--shared-socket', dest='reuse_port', action='store_false',
+                                help='let the workers accept on one inherited listener instead of one SO_REUSEPORT listener each')
+        parser_w.add_argument('--metrics-port', nargs='?', type=int,
+                                help='port the master process serves the metrics of all workers summed up on')
         parser_w.set_defaults(func=WebServer)
 
-        parser_x = subparsers.add_parser('proxy', aliases=['x'], help='run proxy')
-        parser_x.set_defaults(port=8000)
+
+def addProxyArguments(parser_x):
+        parser_x.set_defaults(port=8000, threads=32, backlog=128, timeout=10, cache_dir='proxy_cache',
+                                cache_disk=256, cache_memory=32, cache_report_interval=100,
+                                pool_size=8, pool_idle_timeout=30, dns_ttl=60, log_level='warning', access_log=None,
+                                workers=1, reuse_port=True, metrics_port=None)
         parser_x.add_argument('--port', '-p', type=int, nargs='?',
                                 help='port number to start web server listening on')
+        parser_x.add_argument('--threads', '-n', nargs='?', type=int,
+                                help='number of clients served concurrently')
+        parser_x.add_argument('--backlog', '-b', nargs='?', type=int,
+                                help='maximum number of pending connections queued by the kernel')
+        parser_x.add_argument('--timeout', '-t', nargs='?', type=int,
+                                help='seconds to wait on the origin server before giving up')
+        parser_x.add_argument('--cache-dir', '-d', nargs='?', type=str,
+                                help='directory the response cache is stored in')
+        parser_x.add_argument('--cache-disk', '-D', nargs='?', type=int,
+                                help='megabytes of disk used by the response cache, 0 disables caching')
+        parser_x.add_argument('--cache-memory', '-M', nargs='?', type=int,
+                                help='megabytes of memory used to keep small cached responses')
+        parser_x.add_argument('--cache-report-interval', '-r', nargs='?', type=int,
+                                help='requests between two printed cache statistics lines, 0 disables them')
+        parser_x.add_argument('--pool-size', '-P', nargs='?', type=int,
+                                help='maximum number of connections kept open to one origin server')
+        parser_x.add_argument('--pool-idle-timeout', '-i', nargs='?', type=int,
+                                help='seconds an idle origin connection is kept for reuse')
+        parser_x.add_argument('--dns-ttl', nargs='?', type=int,
+                                help='seconds a resolved hostname is cached for')
+        parser_x.add_argument('--log-level', '-l', nargs='?', type=str, choices=list(AccessLog.levels),
+                                help='least severe messages logged, info logs every request')
+        parser_x.add_argument('--access-log', '-a', nargs='?', type=str,
+                                help='file the log is appended to instead of standard output')
+        parser_x.add_argument('--workers', '-w', nargs='?', type=int,
+                                help='number of worker processes serving the port, each with its own threads or event loop')
+        parser_x.add_argument('--shared-socket', dest='reuse_port', action='store_false',
+                                help='let the workers accept on one inherited listener instead of one SO_REUSEPORT listener each')
+        parser_x.add_argument('--metrics-port', nargs='?', type=int,
+                                help='port the master process serves the metrics of all workers summed up on')
         parser_x.set_defaults(func=Proxy)
 
-        args = parser.parse_args()
-        return args
+
+def addServeArguments(parser_s):
+        parser_s.set_defaults(web_port=None, proxy_port=None, metrics_port=None, ping=[], traceroute=[], timeout=4, rate=100,
+                                interval=1, report_interval=10, trace_interval=60, probes=3, max_hops=30, backlog=128,
+                                keep_alive_timeout=5, max_requests=100, cache_size=64, root='.', cache_dir='proxy_cache',
+                                cache_disk=256, cache_memory=32, cache_report_interval=100, pool_size=8, pool_idle_timeout=30,
+                                dns_ttl=60, log_level='warning', access_log=None, workers=1, index=False, index_refresh=5)
+        parser_s.add_argument('--web-port', '-w', nargs='?', type=int,
+                                help='port the web server listens on, no web server when not given')
+        parser_s.add_argument('--proxy-port', '-x', nargs='?', type=int,
+                                help='port the proxy listens on, no proxy when not given')
+        parser_s.add_argument('--metrics-port', nargs='?', type=int,
+                                help='port serving the metrics in the Prometheus text format')
+        parser_s.add_argument('--ping', '-p', nargs='+', type=str,
+                                help='hosts pinged continuously')
+        parser_s.add_argument('--traceroute', '-t', nargs='+', type=str,
+                                help='hosts whose route is traced periodically')
+        parser_s.add_argument('--interval', '-i', nargs='?', type=float,
+                                help='seconds between two echo requests to the same host')
+        parser_s.add_argument('--report-interval', '-r', nargs='?', type=float,
+                                help='seconds between two printed ping statistics lines')
+        parser_s.add_argument('--trace-interval', nargs='?', type=int,
+                                help='seconds between two traces of the same route, the hop table is printed when the route changes')
+        parser_s.add_argument('--timeout', nargs='?', type=float,
+                                help='seconds to wait for a probe reply or on an origin server')
+        parser_s.add_argument('--root', '-d', nargs='?', type=str,
+                                help='directory the web server looks files up in')
+        parser_s.add_argument('--log-level', '-l', nargs='?', type=str, choices=list(AccessLog.levels),
+                                help='least severe messages logged, info logs every request')
+        parser_s.add_argument('--access-log', '-a', nargs='?', type=str,
+                                help='file the log is appended to instead of standard output')
+        parser_s.set_defaults(func=AsyncRuntime)
+
+
+def addDaemonArguments(parser_d):
+        parser_d.set_defaults(socket=JobDaemon.default_socket, max_jobs=64)
+        parser_d.add_argument('--socket', '-S', nargs='?', type=str,
+                                help='path of the Unix socket the daemon accepts jobs on')
+        parser_d.add_argument('--max-jobs', '-j', nargs='?', type=int,
+                                help='number of jobs running at once, further clients wait to be accepted')
+        parser_d.set_defaults(func=JobDaemon)
+
+
+def addClientArguments(parser_c):
+        parser_c.set_defaults(socket=JobDaemon.default_socket)
+        parser_c.add_argument('--socket', '-S', nargs='?', type=str,
+                                help='path of the Unix socket the daemon accepts jobs on')
+        parser_c.add_argument('job', nargs=argparse.REMAINDER,
+                                help='sub-command and arguments run by the daemon, for example ping 127.0.0.1')
+        parser_c.set_defaults(func=JobClient)
+
+
+def addBenchArguments(parser_b):
+        bench_subparsers = parser_b.add_subparsers(help='benchmark to run')
+        bench_subparsers.required = True
+
+        parser_bc = bench_subparsers.add_parser('checksum', help='check and time the ICMP checksum')
+        parser_bc.set_defaults(sizes=[40, 512, 1500, 9000, 65000], iterations=100000)
+        parser_bc.add_argument('--sizes', '-s', nargs='+', type=int,
+                                help='payload sizes in bytes to time the checksum on')
+        parser_bc.add_argument('--iterations', '-n', nargs='?', type=int,
+                                help='number of checksums timed for a 40 byte payload, scaled down for larger ones')
+        parser_bc.set_defaults(func=ChecksumBenchmark)
+
+        parser_bw = bench_subparsers.add_parser('web', help='load test the web server')
+        parser_bw.set_defaults(target='web')
+        parser_bx = bench_subparsers.add_parser('proxy', help='load test the proxy against a local origin server')
+        parser_bx.set_defaults(target='proxy')
+        for parser_bt in (parser_bw, parser_bx):
+            parser_bt.set_defaults(clients=16, duration=5.0, sizes=[1024, 65536, 1048576], hit_ratios=[1.0, 0.5, 0.0],
+                                    fresh_connections=False, json=None, concurrency='threads', threads=32)
+            parser_bt.add_argument('--clients', '-c', nargs='?', type=int,
+                                    help='number of concurrent clients')
+            parser_bt.add_argument('--duration', '-t', nargs='?', type=float,
+                                    help='seconds each scenario runs for')
+            parser_bt.add_argument('--sizes', '-s', nargs='+', type=int,
+                                    help='file sizes in bytes, one scenario per size and hit ratio')
+            parser_bt.add_argument('--hit-ratios', '-r', nargs='+', type=float,
+                                    help='fractions of requests that should hit the cache')
+            parser_bt.add_argument('--fresh-connections', '-f', action='store_true',
+                                    help='open a new connection for every request instead of keeping it alive')
+            parser_bt.add_argument('--json', '-j', nargs='?', type=str,
+                                    help='file to write machine readable results to, - for standard output')
+            parser_bt.add_argument('--concurrency', '-m', nargs='?', type=str, choices=['serial', 'threads', 'selectors'],
+                                    help='concurrency mode of the web server under test')
+            parser_bt.add_argument('--threads', '-n', nargs='?', type=int,
+                                    help='worker threads of the server under test')
+            parser_bt.set_defaults(func=HttpBenchmark)
+
+        parser_bs = bench_subparsers.add_parser('startup', help='time starting a short job as a new process and through the daemon')
+        parser_bs.set_defaults(runs=20, json=None)
+        parser_bs.add_argument('--runs', '-n', nargs='?', type=int,
+                                help='number of times each way of starting the job is timed')
+        parser_bs.add_argument('--json', '-j', nargs='?', type=str,
+                                help='file to write machine readable results to, - for standard output')
+        parser_bs.add_argument('job', nargs=argparse.REMAINDER,
+                                help='sub-command and arguments timed, ping 127.0.0.1 --count 1 --timeout 1 by default')
+        parser_bs.set_defaults(func=StartupBenchmark)
+
+
+class Metrics:
+    # Process wide counters and latency histograms, rendered in the Prometheus text format. Every thread
+    # updates a shard of its own without taking a lock, the shards are only summed up when the metrics are read.
+    # A counter name may carry labels, e.g. 'web_responses_total{status="200"}'.
+    latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+    descriptions = {
+        "connections_accepted_total": "Connections accepted by the listening socket",
+        "request_parse_seconds": "Time spent parsing complete request headers",
+        "responses_total": "Responses sent by status code",
+        "request_seconds": "Time from a parsed request to its response having been sent",
+        "bytes_sent_total": "Response bytes sent to clients",
+        "disk_read_seconds": "Time spent opening and reading files that were not cached",
+        "cache_hits_total": "Requests answered from the cache without reaching the disk or origin",
+        "cache_misses_total": "Requests the cache could not answer",
+        "cache_revalidated_total": "Stale cache entries the origin confirmed with a 304",
+        "cache_stored_total": "Responses written to the cache",
+        "cache_evicted_total": "Cache entries dropped to stay within the byte budget",
+        "index_hits_total": "Requests whose file was found in the document root index",
+        "index_scans_total": "Scans of the document root that refreshed the index",
+        "upstream_connect_seconds": "Time spent connecting to origin servers",
+        "upstream_reused_total": "Requests sent over a pooled origin connection",
+        "dns_cache_hits_total": "Hostname lookups answered by the resolver cache",
+        "dns_cache_misses_total": "Hostname lookups that went to the system resolver",
+        "probes_sent_total": "Probes sent",
+        "replies_total": "Probe replies received",
+        "timeouts_total": "Probes that got no reply in time",
+        "rtt_seconds": "Round trip time of answered probes",
+    }
+
+    def __init__(self):
+        self.reset()
+        os.register_at_fork(after_in_child=self.reset) # a forked worker starts counting from zero
+
+    def reset(self):
+        self.local = threading.local()
+        self.shards = [] # [counters, histograms] of every thread that recorded something
+        self.lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = [{}, {}]
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def increment(self, name, amount=1):
+        counters = self.shard()[0]
+        counters[name] = counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        histograms = self.shard()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = [[0] * (len(self.latency_buckets) + 1), 0.0, 0]
+        histogram[0][bisect.bisect_left(self.latency_buckets, seconds)] += 1 # buckets are upper bounds, inclusive
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def snapshot(self):
+        # Sums all shards into {"counters": name -> value, "histograms": name -> [bucket counts, sum, count]}
+        with self.lock:
+            shards = list(self.shards)
+        return self.combine([{"counters": dict(shard[0]), "histograms": dict(shard[1])} for shard in shards])
+
+    def combine(self, snapshots):
+        # Sums snapshots, e.g. the ones the worker processes of a Supervisor send to the master
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, value in snapshot["counters"].items():
+                counters[name] = counters.get(name, 0) + value
+            for name, histogram in snapshot["histograms"].items():
+                total = histograms.setdefault(name, [[0] * (len(self.latency_buckets) + 1), 0.0, 0])
+                total[0] = [a + b for a, b in zip(total[0], histogram[0])]
+                total[1] += histogram[1]
+                total[2] += histogram[2]
+        return {"counters": counters, "histograms": histograms}
+
+    def describe(self, lines, name, kind):
+        description = self.descriptions.get(name.partition("_")[2])
+        if description is not None:
+            lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+
+    def render(self, snapshot=None):
+        snapshot = snapshot or self.snapshot()
+        lines = []
+        described = set()
+        for name, value in sorted(snapshot["counters"].items()):
+            base_name = name.partition("{")[0]
+            if base_name not in described:
+                described.add(base_name)
+                self.describe(lines, base_name, "counter")
+            lines.append("%s %s" % (name, value))
+
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            self.describe(lines, name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.latency_buckets + ("+Inf",), histogram[0]):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+            lines.append("%s_sum %.6f" % (name, histogram[1]))
+            lines.append("%s_count %d" % (name, histogram[2]))
+        return "\n".join(lines) + "\n"
+
+
+class AccessLog:
+    # Level gated log whose lines are buffered in memory and written out together once flush_lines have
+    # accumulated or every flush_interval seconds, so a request costs a list append rather than a write.
+    # Messages are only formatted when their level is enabled.
+    levels = {"debug": 10, "info": 20, "warning": 30, "error": 40, "off": 100}
+    flush_lines = 256
+    flush_interval = 1.0 # seconds
+
+    def __init__(self):
+        self.level = self.levels["warning"]
+        self.output = None # standard output, looked up on every flush
+        self.lines = []
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.stamp = [0, ""] # second and its formatted timestamp
+
+    def configure(self, level, path=None):
+        self.level = self.levels[level]
+        if path:
+            output = open(path, "a")
+            with self.lock:
+                # Lines buffered so far belong to the previous output, which is closed rather than leaked
+                self.flushLocked()
+                if self.output is not None:
+                    self.output.close()
+                self.output = output
+        if self.flusher is None:
+            self.startFlusher()
+            atexit.register(self.flush)
+            os.register_at_fork(after_in_child=self.afterFork)
+
+    def startFlusher(self):
+        self.flusher = threading.Thread(target=self.flushPeriodically, daemon=True)
+        self.flusher.start()
+
+    def afterFork(self):
+        # The flusher thread does not survive a fork and the parent's buffered lines are its own to write
+        self.lock = threading.Lock()
+        self.lines = []
+        self.startFlusher()
+
+    def enabled(self, level):
+        return self.levels[level] >= self.level
+
+    def write(self, level, message, *values):
+        if self.levels[level] < self.level:
+            return
+        now = int(time())
+        if self.stamp[0] != now:
+            self.stamp = [now, strftime("%d/%b/%Y:%H:%M:%S +0000", gmtime(now))]
+        line = "[%s] %s %s\n" % (self.stamp[1], level.upper(), message % values)
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.flush_lines:
+                self.flushLocked()
+
+    def flush(self):
+        with self.lock:
+            self.flushLocked()
+
+    def flushLocked(self):
+        if not self.lines:
+            return
+        output = self.output or sys.stdout
+        try:
+            output.write("".join(self.lines))
+            output.flush()
+        except (OSError, ValueError):
+            pass # a closed output should not take the server down with it
+        self.lines = []
+
+    def flushPeriodically(self):
+        while True:
+            sleep(self.flush_interval)
+            self.flush()
+
+
+metrics = Metrics()
+log = AccessLog()
+
+
+class Supervisor:
+    # Runs a WebServer or Proxy as several forked worker processes serving the same port, so parsing and
+    # copying use every core instead of sharing one GIL. Each worker binds a listener of its own with
+    # SO_REUSEPORT and the kernel spreads new connections over them, or all workers accept on the listener
+    # created before forking. Workers that die are replaced, SIGHUP replaces every worker with a new one and
+    # SIGTERM or SIGINT stop them gracefully. Each worker sends its metrics snapshot to the master over a pipe.
+    stats_interval = 1.0 # seconds between two metrics snapshots sent by a worker
+    restart_delay = 1.0 # seconds before a worker that died right after starting is replaced
+
+    def __init__(self, application, args):
+        self.application = application
+        self.args = args
+        self.reuse_port = args.reuse_port and hasattr(socket, "SO_REUSEPORT")
+        self.listener = None
+        self.metrics_socket = None
+        self.workers = {} # pid -> {"number", "pipe", "buffer", "snapshot", "started", "retiring"}
+        self.retired = [] # last snapshots of the workers that exited
+        self.pending = [] # [time, worker number] of workers to start again
+        self.stopping = False
+        self.restarting = False
+        self.stats_lock = threading.Lock()
+
+    def startWorker(self, number):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for worker in self.workers.values():
+                os.close(worker["pipe"])
+            self.runWorker(write_fd, number) # never returns
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self.workers[pid] = {"number": number, "pipe": read_fd, "buffer": b"", "snapshot": None,
+                             "started": time(), "retiring": False}
+
+    def runWorker(self, statsFd, number):
+        status = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C reaches the master, which stops the workers
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, self.application.stopServing)
+            if self.metrics_socket is not None:
+                self.metrics_socket.close()
+            listener = self.listener or self.application.createServerSocket(self.args.port, self.args.backlog, True)
+            self.application.listener = listener
+            self.application.prepareWorker(number, self.args)
+            threading.Thread(target=self.reportStatistics, args=(statsFd,), daemon=True).start()
+            self.application.serveListener(listener, self.args)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            try:
+                self.sendSnapshot(statsFd)
+            except OSError:
+                pass
+            log.flush()
+            sys.stdout.flush()
+        os._exit(status)
+
+    def sendSnapshot(self, statsFd):
+        data = (json.dumps(metrics.snapshot()) + "\n").encode()
+        with self.stats_lock:
+            while data:
+                data = data[os.write(statsFd, data):]
+
+    def reportStatistics(self, statsFd):
+        while True:
+            sleep(self.stats_interval)
+            try:
+                self.sendSnapshot(statsFd)
+            except OSError:
+                return
+
+    def readStatistics(self, timeout):
+        # Keeps the latest snapshot of every worker, a snapshot is one JSON line
+        pipes = {worker["pipe"]: worker for worker in self.workers.values()}
+        try:
+            readable = select.select(list(pipes), [], [], timeout)[0]
+        except OSError:
+            return
+        for pipe in readable:
+            self.drainPipe(pipes[pipe])
+
+    def drainPipe(self, worker):
+        while True:
+            try:
+                data = os.read(worker["pipe"], 65536)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            worker["buffer"] += data
+        *lines, worker["buffer"] = worker["buffer"].split(b"\n")
+        if lines:
+            worker["snapshot"] = json.loads(lines[-1])
+
+    def snapshot(self):
+        # The metrics of every worker summed up, including the ones that have exited since
+        live = [worker["snapshot"] for worker in self.workers.values() if worker["snapshot"] is not None]
+        return metrics.combine(self.retired + live)
+
+    def reapWorkers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            self.drainPipe(worker)
+            os.close(worker["pipe"])
+            if worker["snapshot"] is not None:
+                self.retired.append(worker["snapshot"])
+            if not self.stopping and not worker["retiring"]:
+                print("Worker %d (pid %d) exited with status %d, starting a new one" % (worker["number"], pid, os.waitstatus_to_exitcode(status)))
+                delay = self.restart_delay if time() - worker["started"] < self.restart_delay else 0
+                self.pending.append([time() + delay, worker["number"]])
+
+    def stop(self, signalNumber=None, frame=None):
+        self.stopping = True
+
+    def restart(self, signalNumber=None, frame=None):
+        self.restarting = True
+
+    def run(self):
+        # 1. In shared mode the listener is created once and inherited by every worker
+        if not self.reuse_port:
+            self.listener = self.application.createServerSocket(self.args.port, self.args.backlog)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.restart)
+        if self.args.metrics_port:
+            self.metrics_socket = self.application.serveMetrics(self.args.metrics_port, lambda: metrics.render(self.snapshot()))
+
+        # 2. Start the workers, then supervise them until they have all stopped
+        for number in range(self.args.workers):
+            self.startWorker(number)
+        print("Started %d workers on port %d (%s)" % (self.args.workers, self.args.port,
+                                                      "SO_REUSEPORT" if self.reuse_port else "shared listener"))
+        stop_deadline = None
+        while self.workers or (self.pending and not self.stopping):
+            self.readStatistics(0.5)
+            self.reapWorkers()
+
+            if self.restarting and not self.stopping:
+                # Every worker gets a replacement before it is told to stop, so the port is always served
+                self.restarting = False
+                for pid, worker in list(self.workers.items()):
+                    if not worker["retiring"]:
+                        self.startWorker(worker["number"])
+                        worker["retiring"] = True
+                        os.kill(pid, signal.SIGTERM)
+
+            for entry in [entry for entry in self.pending if entry[0] <= time() and not self.stopping]:
+                self.pending.remove(entry)
+                self.startWorker(entry[1])
+
+            if self.stopping and stop_deadline is None:
+                stop_deadline = time() + self.application.shutdown_timeout + 1
+                for pid in self.workers:
+                    os.kill(pid, signal.SIGTERM)
+            elif stop_deadline is not None and time() > stop_deadline:
+                for pid in self.workers:
+                    os.kill(pid, signal.SIGKILL)
+
+        # 3. Report what the workers did
+        counters = self.snapshot()["counters"]
+        prefix = self.application.metric_prefix
+        requests = sum(value for name, value in counters.items() if name.startswith(prefix + "_responses_total"))
+        print("Workers stopped after serving %d requests and sending %d bytes"
+              % (requests, counters.get(prefix + "_bytes_sent_total", 0)))
+        if self.listener is not None:
+            self.listener.close()
+
+
+class RequestTooLargeError(ValueError):
+    # Raised by the request parser when the Content-Length is above max_body_size, answered with a 413
+    pass
 
 
 class NetworkApplication:
 
     def checksum(self, dataToChecksum: str) -> str:
+        # Same result as referenceChecksum without a Python level loop. The words are summed little endian like
+        # the reference does, and since 2**16 is 1 modulo 0xffff the ones' complement sum of all words is the
+        # whole packet read as one little endian integer modulo 0xffff, which int.from_bytes and % do in C.
+        value = int.from_bytes(dataToChecksum, "little")
+        return self.finishChecksum(value % 0xffff, value != 0)
+
+    def finishChecksum(self, remainder, nonZero):
+        # Turns the word sum modulo 0xffff into the value checksum returns. End-around carry folding never
+        # gives 0 for a non-zero sum, so a remainder of 0 stands for 0xffff unless every word was zero.
+        csum = remainder or (0xffff if nonZero else 0)
+        answer = ~csum
+        answer = answer & 0xffff
+        answer = answer >> 8 | (answer << 8 & 0xff00)
+
+        answer = socket.htons(answer)
+
+        return answer
+
+    def percentile(self, sortedValues, fraction):
+        # Nearest rank percentile
+        if not sortedValues:
+            return 0.0
+        return sortedValues[max(0, math.ceil(fraction * len(sortedValues)) - 1)]
+
+    def writeReport(self, path, results, **fields):
+        # Machine readable benchmark results for comparing runs, written to path or to standard output for -
+        report = {"date": ctime(), "python": sys.version.split()[0], **fields, "results": results}
+        if path == "-":
+            print(json.dumps(report, indent=2))
+        else:
+            with open(path, "w") as reportFile:
+                json.dump(report, reportFile, indent=2)
+
+    def referenceChecksum(self, dataToChecksum: str) -> str:
+        # The original word by word implementation, kept to check checksum against in the benchmark
         csum = 0
         countTo = (len(dataToChecksum) // 2) * 2
         count = 0
@@ -94,16 +786,404 @@ class NetworkApplication:
 
         return answer
 
+    max_header_size = 8192 # largest HTTP header accepted before the request is rejected
+    max_body_size = None # largest request body accepted, None when bodies are streamed rather than buffered
+    metric_prefix = "app" # first part of the names of the metrics recorded by a subcommand
+    metrics_path = "/metrics" # path the web server and proxy answer with the metrics in the Prometheus text format
+    metrics_content_type = "text/plain; version=0.0.4; charset=utf-8"
+    shutdown_timeout = 10 # seconds a stopping worker process waits for the requests it is serving
+    stopping = False
+    listener = None # listening socket closed by stopServing
+
+    def parseRequestHeader(self, header):
+        # Parses a request line and header fields ending before the empty line, the returned request has an
+        # empty body and its length is the number of body bytes that follow the header
+        lines = header.decode("iso-8859-1").split("\r\n")
+        request_line = lines[0].split()
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/"):
+            raise ValueError("malformed request line")
+
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(":")
+            if not separator:
+                raise ValueError("malformed header line")
+            headers[name.strip().lower()] = value.strip()
+
+        # The end of a request body is found using Content-Length, chunked request bodies are not supported
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise ValueError("chunked request bodies are not supported")
+        content_length = headers.get("content-length", "0")
+        if not content_length.isascii() or not content_length.isdigit():
+            raise ValueError("malformed content length")
+        if self.max_body_size is not None and int(content_length) > self.max_body_size:
+            raise RequestTooLargeError("request body of %s bytes" % content_length)
+        return {"method": request_line[0], "path": request_line[1], "version": request_line[2],
+                "headers": headers, "body": b"", "length": int(content_length)}
+
+    def takeRequest(self, buffer, progress, withBody=True):
+        # Incremental HTTP request parser over a bytearray that received data is appended to. Returns None until
+        # the buffer holds a complete request, which is then removed from the front of the buffer so pipelined
+        # requests stay behind it. progress is an empty dict kept with the buffer, it holds how far the end of
+        # the header has been looked for and the parsed header while the body arrives, so every byte is scanned
+        # once and the header parsed once however the data is split. Without withBody the request is returned as
+        # soon as its header is complete and its body is left in the buffer for the caller to stream.
+        request = progress.get("request")
+        if request is None:
+            start = time()
+            if buffer[:1] in (b"\r", b"\n"): # empty lines before a request are ignored
+                del buffer[:len(buffer) - len(buffer.lstrip(b"\r\n"))]
+                progress["searched"] = 0
+            header_end = buffer.find(b"\r\n\r\n", max(0, progress.get("searched", 0) - 3))
+            if header_end < 0:
+                if len(buffer) > self.max_header_size:
+                    raise ValueError("request header too large")
+                progress["searched"] = len(buffer)
+                return None
+            request = self.parseRequestHeader(bytes(buffer[:header_end]))
+            del buffer[:header_end + 4]
+            metrics.observe(self.metric_prefix + "_request_parse_seconds", time() - start)
+            progress["request"] = request
+
+        if withBody:
+            if len(buffer) < request["length"]:
+                return None
+            request["body"] = bytes(buffer[:request["length"]])
+            del buffer[:request["length"]]
+        progress.clear()
+        return request
+
+    def parseResponseHeader(self, header):
+        # Returns the status code and the lower cased header fields of a complete response header
+        lines = header.decode("iso-8859-1").split("\r\n")
+        status_line = lines[0].split()
+        if len(status_line) < 2 or not status_line[1].isdigit():
+            raise ValueError("malformed status line")
+
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(":")
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+        return [int(status_line[1]), headers]
+
+    def createServerSocket(self, port, backlog, reusePort=False):
+        # 1. Create server socket, with reusePort several processes can bind the same port and the kernel
+        # spreads the incoming connections over their listeners
+        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        # 2. Bind the server socket to server address and server port
+        serverSocket.bind(("localhost", port))
+
+        # 3. Listen for connections, letting the kernel queue up to backlog pending connections
+        serverSocket.listen(backlog)
+        return serverSocket
+
+    def runToCompletion(self, coroutine):
+        # Runs a request path shared with the async runtime on the calling thread. Over SocketStreams and
+        # UpstreamPool nothing it awaits ever suspends, so it finishes within its first step.
+        try:
+            coroutine.send(None)
+        except StopIteration as finished:
+            return finished.value
+        coroutine.close()
+        raise RuntimeError("a request path suspended outside of an event loop")
+
+    def serveThreadPool(self, serverSocket, threads):
+        # Hands every accepted connection to handleRequest on a bounded pool of worker threads,
+        # the semaphore bounds the number of accepted connections waiting for a worker,
+        # once every worker is busy further connections stay queued in the kernel backlog.
+        # Workers are daemon threads so an idle keep-alive connection never delays the process exiting.
+        connections = queue.SimpleQueue()
+        slots = threading.BoundedSemaphore(threads)
+
+        def worker():
+            while True:
+                connectionSocket = connections.get()
+                try:
+                    self.handleRequest(connectionSocket)
+                except Exception:
+                    # A bug hit by one connection must not end its worker, the pool would shrink for good
+                    log.write("error", "Error serving a connection: %s", traceback.format_exc().rstrip())
+                    connectionSocket.close()
+                finally:
+                    slots.release()
+
+        for i in range(threads):
+            threading.Thread(target=worker, daemon=True).start()
+
+        while True:
+            slots.acquire()
+            try:
+                connectionSocket, address = serverSocket.accept()
+            except OSError:
+                if not self.stopping:
+                    raise
+                slots.release()
+                break
+            connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            metrics.increment(self.metric_prefix + "_connections_accepted_total")
+            connections.put(connectionSocket)
+
+        # Stopping, every slot is free again once the workers finished the connections they were serving
+        deadline = time() + self.shutdown_timeout
+        for i in range(threads):
+            if not slots.acquire(timeout=max(0, deadline - time())):
+                break
+
+    def prepareWorker(self, number, args):
+        # Called in a freshly forked worker process of a Supervisor, for the state each worker keeps to itself
+        pass
+
+    def stopServing(self, signalNumber=None, frame=None):
+        # SIGTERM handler of a worker process, closing the listener makes the blocked accept fail
+        # so the serve loop stops taking connections and finishes the ones it has
+        self.stopping = True
+        if self.listener is not None:
+            self.listener.close()
+
+    def metricsResponse(self, method, connectionHeader, text=None):
+        # Status line, headers and (unless the method is HEAD) the current metrics, ready to be sent
+        body = (text if text is not None else metrics.render()).encode()
+        header = ("HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n\r\n"
+                  % (self.metrics_content_type, len(body), connectionHeader)).encode()
+        return header if method == "HEAD" else header + body
+
+    def serveMetrics(self, port, render=None):
+        # For the subcommands that are not HTTP servers themselves, every request on port gets the metrics,
+        # render returns the text to send when it is not this process's own metrics. Returns the listener.
+        serverSocket = self.createServerSocket(port, 16)
+
+        def serve():
+            while True:
+                connectionSocket, address = serverSocket.accept()
+                try:
+                    connectionSocket.settimeout(5)
+                    request = b""
+                    while b"\r\n\r\n" not in request and len(request) <= self.max_header_size:
+                        data = connectionSocket.recv(4096)
+                        if not data:
+                            break
+                        request += data
+                    connectionSocket.sendall(self.metricsResponse(request.split(b" ")[0].decode("iso-8859-1"), "Connection: close",
+                                                                  render() if render is not None else None))
+                except OSError:
+                    pass
+                finally:
+                    connectionSocket.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        return serverSocket
+
+    async def serveMetricsAsync(self, port):
+        # serveMetrics as a service of the async runtime
+        async def answer(reader, writer):
+            try:
+                request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+                writer.write(self.metricsResponse(request.split(b" ")[0].decode("iso-8859-1"), "Connection: close"))
+                await writer.drain()
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                pass
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(answer, "localhost", port)
+        async with server:
+            await server.serve_forever()
+
+    echo_data = bytes("abcdefghijklmnopqrstuvwabcdefghi", "ascii") # 32 byte payload carried by echo requests
+    echo_sums = {} # (ID, data) -> word sum of an echo request without its sequence number, shared by all instances
+
+    def readTargets(self, args):
+        # The hosts given on the command line followed by those of --targets-file, one per line, # starts a comment
+        hostnames = [args.hostname] if isinstance(args.hostname, str) else list(args.hostname)
+        if args.targets_file:
+            with open(args.targets_file) as targetsFile:
+                for line in targetsFile:
+                    line = line.split("#")[0].strip()
+                    if line:
+                        hostnames.append(line)
+        if not hostnames:
+            print("No hosts in %s" % (args.targets_file), file=sys.stderr)
+            sys.exit(2)
+        return hostnames
+
+    def resolveHostnames(self, hostnames):
+        # Hostnames are resolved in parallel, the ones that do not resolve are reported and skipped.
+        # Returns [hostname, address] pairs in the order of hostnames.
+        def resolve(hostname):
+            try:
+                return socket.gethostbyname(hostname)
+            except OSError as error:
+                print("%s: %s" % (hostname, error), file=sys.stderr)
+                return None
+
+        # A single hostname, the common case, needs neither the thread pool nor concurrent.futures imported
+        if len(hostnames) == 1:
+            addresses = [resolve(hostnames[0])]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=32) as pool:
+                addresses = list(pool.map(resolve, hostnames))
+        return [[hostname, address] for hostname, address in zip(hostnames, addresses) if address is not None]
+
+    def createICMPSocket(self):
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+
+    def buildEchoRequest(self, ID, sequenceNumber, data=None):
+        # Type 8, code 0, the checksum is computed over the packet with a zero checksum field and then inserted.
+        # Only the sequence number changes between the echo requests of a target, so the word sum of the rest is
+        # computed once per (ID, data) and the sequence number word, read little endian, is added to it.
+        data = self.echo_data if data is None else data
+        partial_sum = self.echo_sums.get((ID, data))
+        if partial_sum is None:
+            partial_sum = int.from_bytes(struct.pack("!BBHHH", 8, 0, 0, ID, 0) + data, "little") % 0xffff
+            if len(self.echo_sums) >= 4096:
+                self.echo_sums.clear()
+            self.echo_sums[(ID, data)] = partial_sum
+        sequence_word = (sequenceNumber >> 8) | ((sequenceNumber & 0xff) << 8)
+        checksum_res = self.finishChecksum((partial_sum + sequence_word) % 0xffff, True) # the type byte is never zero
+        return struct.pack("!BBHHH", 8, 0, socket.htons(checksum_res), ID, sequenceNumber) + data
+
+    def parseICMPPacket(self, packet):
+        # Splits a packet read from a raw ICMP socket into the fields needed to match it to a probe,
+        # id and seq are only meaningful for echo requests and replies
+        ip_header_length = (packet[0] & 0x0f) * 4
+        if len(packet) < ip_header_length + 8:
+            return None
+        icmp_type, code, checksum, ID, sequence_number = struct.unpack("!BBHHH", packet[ip_header_length:ip_header_length + 8])
+        reply = {"type": icmp_type, "code": code, "source": socket.inet_ntoa(packet[12:16]), "ttl": packet[8],
+                 "id": ID, "seq": sequence_number, "size": len(packet) - ip_header_length, "quoted": None}
+        if icmp_type in (3, 11): # Destination Unreachable and Time Exceeded quote the probe that caused them
+            reply["quoted"] = self.parseQuotedHeader(packet[ip_header_length + 8:])
+        return reply
+
+    def parseQuotedHeader(self, quoted):
+        # ICMP errors carry the IP header and first 8 bytes of the offending packet (RFC 792), that is
+        # enough to recover the identifier and sequence number of an echo request or the UDP header
+        if len(quoted) < 20:
+            return None
+        quoted_header_length = (quoted[0] & 0x0f) * 4
+        transport = quoted[quoted_header_length:quoted_header_length + 8]
+        if len(transport) < 8:
+            return None
+        header = {"protocol": quoted[9], "destination": socket.inet_ntoa(quoted[16:20])}
+        if header["protocol"] == socket.IPPROTO_ICMP:
+            icmp_type, code, checksum, header["id"], header["seq"] = struct.unpack("!BBHHH", transport)
+        elif header["protocol"] == socket.IPPROTO_UDP:
+            header["source_port"], header["destination_port"], header["length"], header["checksum"] = struct.unpack("!HHHH", transport)
+        return header
+
+    def collectProbeReplies(self, icmpSocket, probes, timeout, matchReply, isDone=None):
+        # Waits for the replies to probes that are all in flight at once. probes maps a probe key to
+        # [ttl, sending time], matchReply(reply) returns the key a parsed ICMP reply belongs to (or None)
+        # and isDone(results) may end the wait early. Returns key -> [address, rtt in ms, ICMP type].
+        results = {}
+        deadline = max([probe[1] for probe in probes.values()], default=time()) + timeout
+        while len(results) < len(probes):
+            ready = select.select([icmpSocket], [], [], max(0, deadline - time()))
+            if not ready[0]:
+                break
+            packet = icmpSocket.recv(2048)
+            receiving_time = time()
+            reply = self.parseICMPPacket(packet)
+            key = matchReply(reply) if reply is not None else None
+            if key is None or key not in probes or key in results:
+                continue
+            results[key] = [reply["source"], 1000 * (receiving_time - probes[key][1]), reply["type"]]
+            metrics.increment(self.metric_prefix + "_replies_total")
+            metrics.observe(self.metric_prefix + "_rtt_seconds", receiving_time - probes[key][1])
+            if isDone is not None and isDone(results):
+                break
+        return results
+
+    async def collectProbeRepliesAsync(self, icmpSocket, probes, timeout, matchReply, isDone=None):
+        # collectProbeReplies for the event loop, the non-blocking raw socket is registered with loop.add_reader
+        # instead of waited on with select, so other services keep running while the replies come in
+        loop = asyncio.get_running_loop()
+        results = {}
+        finished = loop.create_future()
+
+        def readReplies():
+            while not finished.done():
+                try:
+                    packet = icmpSocket.recv(2048)
+                except OSError:
+                    return
+                receiving_time = time()
+                reply = self.parseICMPPacket(packet)
+                key = matchReply(reply) if reply is not None else None
+                if key is None or key not in probes or key in results:
+                    continue
+                results[key] = [reply["source"], 1000 * (receiving_time - probes[key][1]), reply["type"]]
+                metrics.increment(self.metric_prefix + "_replies_total")
+                metrics.observe(self.metric_prefix + "_rtt_seconds", receiving_time - probes[key][1])
+                if len(results) == len(probes) or (isDone is not None and isDone(results)):
+                    finished.set_result(None)
+
+        deadline = max([probe[1] for probe in probes.values()], default=time()) + timeout
+        loop.add_reader(icmpSocket.fileno(), readReplies)
+        try:
+            await asyncio.wait([finished], timeout=max(0, deadline - time()))
+        finally:
+            loop.remove_reader(icmpSocket.fileno())
+            finished.cancel()
+        return results
+
+    def destinationHop(self, probes, results, destinationAddress):
+        # The first ttl at which the destination itself answered, None while it has not been reached
+        hops = [probes[key][0] for key, result in results.items() if result[0] == destinationAddress]
+        return min(hops) if hops else None
+
+    def allHopsAnswered(self, probes, destinationAddress):
+        # isDone for collectProbeReplies, true once the destination answered and every probe before it has a reply
+        def isDone(results):
+            last_hop = self.destinationHop(probes, results, destinationAddress)
+            if last_hop is None:
+                return False
+            return all(key in results for key, probe in probes.items() if probe[0] <= last_hop)
+        return isDone
+
+    def hopAddresses(self, probes, results, destinationAddress, maxHops):
+        # The address that answered first at every ttl up to the destination, None for a hop that did not answer
+        last_hop = self.destinationHop(probes, results, destinationAddress) or maxHops
+        addresses = [None] * last_hop
+        for key, probe in sorted(probes.items(), key=lambda item: item[1][1]):
+            result = results.get(key)
+            if result is not None and probe[0] <= last_hop and addresses[probe[0] - 1] is None:
+                addresses[probe[0] - 1] = result[0]
+        return addresses
+
+    def printHopTable(self, probes, results, destinationAddress, maxHops):
+        # Assembles the replies to all probes into one line per hop, up to the hop the destination answered from
+        last_hop = self.destinationHop(probes, results, destinationAddress) or maxHops
+        for ttl in range(1, last_hop + 1):
+            measurements = []
+            address = None
+            for key, probe in sorted(probes.items(), key=lambda item: item[1][1]):
+                if probe[0] != ttl:
+                    continue
+                result = results.get(key)
+                measurements.append(result[1] if result is not None else None)
+                if result is not None and address is None:
+                    address = result[0]
+            self.printMultipleResults(ttl, address or '', measurements, address or '')
+
     def printOneResult(self, destinationAddress: str, packetLength: int, time: float, ttl: int, destinationHostname=''):
         if destinationHostname:
             print("%d bytes from %s (%s): ttl=%d time=%.2f ms" % (packetLength, destinationHostname, destinationAddress, ttl, time))
         else:
             print("%d bytes from %s: ttl=%d time=%.2f ms" % (packetLength, destinationAddress, ttl, time))
 
-    def printAdditionalDetails(self, packetLoss=0.0, minimumDelay=0.0, averageDelay=0.0, maximumDelay=0.0):
+    def printAdditionalDetails(self, packetLoss=0.0, minimumDelay=0.0, averageDelay=0.0, maximumDelay=0.0, deviation=None):
         print("%.2f%% packet loss" % (packetLoss))
         if minimumDelay > 0 and averageDelay > 0 and maximumDelay > 0:
-            print("rtt min/avg/max = %.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay))
+            if deviation is None:
+                print("rtt min/avg/max = %.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay))
+            else:
+                print("rtt min/avg/max/mdev = %.2f/%.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay, deviation))
 
     def printMultipleResults(self, ttl: int, destinationAddress: str, measurements: list, destinationHostname=''):
         latencies = ''
@@ -121,100 +1201,362 @@ class NetworkApplication:
         else:
             print("%d %s" % (ttl, latencies))
 
+class QuantileSketch:
+    # Streaming estimate of one quantile with the P-square algorithm (Jain and Chlamtac, 1985). Five markers
+    # follow the minimum, the quantile, the maximum and two points in between, their heights are adjusted
+    # with a parabolic formula as observations arrive, so memory stays constant however long ping runs.
+    def __init__(self, quantile):
+        self.quantile = quantile
+        self.heights = [] # the first five observations, sorted, then the marker heights
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        if len(self.heights) < 5:
+            bisect.insort(self.heights, value)
+            return
+
+        # 1. Find the cell of the value, the extreme markers follow the minimum and the maximum
+        if value < self.heights[0]:
+            self.heights[0] = value
+            cell = 0
+        elif value >= self.heights[4]:
+            self.heights[4] = value
+            cell = 3
+        else:
+            cell = bisect.bisect_right(self.heights, value) - 1
+        for i in range(cell + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # 2. Move the middle markers that are a position or more away from where they should be
+        for i in (1, 2, 3):
+            offset = self.desired[i] - self.positions[i]
+            if ((offset >= 1 and self.positions[i + 1] - self.positions[i] > 1)
+                    or (offset <= -1 and self.positions[i - 1] - self.positions[i] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self.parabolic(i, step)
+                if not self.heights[i - 1] < height < self.heights[i + 1]:
+                    height = self.linear(i, step)
+                self.heights[i] = height
+                self.positions[i] += step
+
+    def parabolic(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + step) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - step) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+    def linear(self, i, step):
+        q, n = self.heights, self.positions
+        return q[i] + step * (q[i + step] - q[i]) / (n[i + step] - n[i])
+
+    def value(self):
+        if not self.heights:
+            return 0.0
+        if len(self.heights) < 5:
+            # Nearest rank on the few observations seen so far
+            return self.heights[max(0, math.ceil(self.quantile * len(self.heights)) - 1)]
+        return self.heights[2]
+
+
+class PingSeriesLog:
+    # Time series of every probe result, appended to a CSV file or to a binary file of fixed size records
+    # (time, IPv4 address, sequence number, RTT in ms with NaN for a lost probe). Writes go through a large
+    # file buffer and are flushed with every summary, so a monitor running for days costs a write per block.
+    record = struct.Struct("!d4sHf")
+
+    def __init__(self, path, format):
+        self.binary = format == "binary"
+        self.file = open(path, "ab" if self.binary else "a", buffering=65536)
+        if not self.binary and self.file.tell() == 0:
+            self.file.write("time,host,address,sequence,rtt_ms\n")
+
+    def write(self, target, sequenceNumber, delay):
+        if self.binary:
+            self.file.write(self.record.pack(time(), socket.inet_aton(target["address"]), sequenceNumber,
+                                             math.nan if delay is None else delay))
+        else:
+            self.file.write("%.6f,%s,%s,%d,%s\n" % (time(), target["hostname"], target["address"], sequenceNumber,
+                                                    "" if delay is None else "%.3f" % delay))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
 class ICMPPing(NetworkApplication):
-    current_seq_num = 0
-    sending_time = 0
+    metric_prefix = "ping"
+    rate = 100 # echo requests per second sent across all targets
+    interval = 1 # seconds between two echo requests to the same target
 
-    def receiveOnePing(self, icmpSocket, destinationAddress, ID, timeout):
+    def receiveOnePing(self, icmpSocket, timeout):
         # 1. Wait for the socket to receive a reply
-        ready = select.select([icmpSocket], [], [], timeout)
-        if ready[0]:
-            echo_response = icmpSocket.recv(1000) # will receive at most 100 bytes
-        else:
-            return -1
+        ready = select.select([icmpSocket], [], [], max(0, timeout))
+        if not ready[0]:
+            return None
+        echo_response = icmpSocket.recv(2048)
 
-        # 2. Once received, record time of receipt, otherwise, handle a timeout
+        # 2. Once received, record time of receipt
         receiving_time = time()
 
-        # 3. Compare the time of receipt to time of sending, producing the total network delay
-        delay = receiving_time - self.sending_time
+        # 3. Unpack the packet header for useful information, including the ID and sequence number,
+        # the raw socket also sees every other ICMP message (our own requests on loopback included)
+        reply = self.parseICMPPacket(echo_response)
+        if reply is None or reply["type"] != 0:
+            return None
+        reply["time"] = receiving_time
+        return reply
 
-        # 4. Unpack the packet header for useful information, including the ID
-        icmpHeader = echo_response[20:28]
-        type, code, checksum, rec_ID, seq_num = struct.unpack("!BBHHH", icmpHeader)
+    def sendOnePing(self, icmpSocket, destinationAddress, ID, sequenceNumber):
+        # 1. Build the ICMP echo request, the identifier names the target and the sequence number the probe
+        icmp_packet = self.buildEchoRequest(ID, sequenceNumber)
 
-        # 5. Check that the ID matches between the request and reply
-        if (ID != rec_ID):
-            return -1
+        # 2. Send packet using socket
+        icmpSocket.sendto(icmp_packet, (destinationAddress, 1))
 
-        # 6. Return total network delay
-        ttl = struct.unpack("!BBHHHBBHII", echo_response[0:20])[5] # we are extracting the ttl from the ip header
-        return [1000*delay, ttl]
+        # 3. Record time of sending
+        return time()
 
-    def sendOnePing(self, icmpSocket, destinationAddress, ID):
-        # 1. Build ICMP header
-        # struct.pack is putting same values together as if it is a C Structure
-        # we should have a structure containg the following: 
-            # Type = 8 on wireshark --- (8 bits)
-            # Code = 0 on wireshark --- (8 bits)
-            # Checksum = will be calculated after creating the structure -- (16 bits)
-            # Identifier = can contain any value and is used to identify the packet --- (16 bits)
-            # Sequence Number = on wireshark each packet send seq_num is incremented from the previous packet --- (16 bits)
-        self.current_seq_num += 1
-        data = bytes("abcdefghijklmnopqrstuvwabcdefghi", "ascii") # here we are sending 32 bytes
-        icmp_packet = struct.pack("!BBHHH", 8, 0, 0, ID, self.current_seq_num) + data # The form '!' represents the network byte order which is always big-endian as defined in IETF RFC 1700.
+    def newTarget(self, hostname, address, ID):
+        # Streaming aggregates only, the running mean and variance (Welford) and two quantile sketches,
+        # so memory does not grow with the count
+        return {"hostname": hostname, "address": address, "id": ID, "sent": 0, "received": 0,
+                "minimum": 0.0, "maximum": 0.0, "mean": 0.0, "m2": 0.0,
+                "p50": QuantileSketch(0.5), "p99": QuantileSketch(0.99)}
 
-        # 2. Checksum ICMP packet using given function
-        checksum_res = self.checksum(icmp_packet)
+    def recordReply(self, target, delay):
+        if target["received"] == 0 or delay < target["minimum"]:
+            target["minimum"] = delay
+        target["maximum"] = max(target["maximum"], delay)
+        target["received"] += 1
+        change = delay - target["mean"]
+        target["mean"] += change / target["received"]
+        target["m2"] += change * (delay - target["mean"])
+        target["p50"].add(delay)
+        target["p99"].add(delay)
 
-        # 3. Insert checksum into packet
-        icmp_packet = struct.pack("!BBHHH", 8, 0, socket.htons(checksum_res), ID, self.current_seq_num) + data
+    def pingTargets(self, targets, count, timeout, onResult=None):
+        # Pings every target count times, or until interrupted when count is 0, over one shared raw socket.
+        # Requests are paced to self.rate per second and each target is probed every self.interval seconds,
+        # replies are matched back to their target and probe through the (identifier, sequence number) pair.
+        # onResult(target, sequenceNumber, reply, delay) is called for every reply and, with reply None, for
+        # every timeout.
+        icmp_socket = self.createICMPSocket()
+        outstanding = collections.OrderedDict() # (identifier, sequence number) -> [target, send time, deadline], oldest first
+        rounds = range(count) if count > 0 else itertools.count()
+        probes = ((round_number, target) for round_number in rounds for target in targets)
+        next_probe = next(probes, None)
+        start = next_send = time()
 
-        # 4. Send packet using socket
-        icmpSocket.sendto(icmp_packet, (destinationAddress, 1))
+        try:
+            while next_probe is not None or outstanding:
+                # 1. Send every probe that is due, in rounds over all targets
+                now = time()
+                while next_probe is not None:
+                    round_number, target = next_probe
+                    due = max(next_send, start + round_number * self.interval)
+                    if due > now:
+                        break
+                    sequence_number = (round_number + 1) & 0xffff
+                    try:
+                        sending_time = self.sendOnePing(icmp_socket, target["address"], target["id"], sequence_number)
+                    except OSError:
+                        sending_time = now # unreachable right away, reported as a timeout
+                    target["sent"] += 1
+                    metrics.increment("ping_probes_sent_total")
+                    outstanding[(target["id"], sequence_number)] = [target, sending_time, sending_time + timeout]
+                    next_send = due + 1.0 / self.rate
+                    next_probe = next(probes, None)
 
-        # 5. Record time of sending
-        self.sending_time = time()
+                # 2. Probes that outlived the timeout are lost
+                while outstanding:
+                    key, probe = next(iter(outstanding.items()))
+                    if probe[2] > now:
+                        break
+                    del outstanding[key]
+                    metrics.increment("ping_timeouts_total")
+                    if onResult is not None:
+                        onResult(probe[0], key[1], None, None)
 
+                # 3. Wait for a reply until the next probe is due or the oldest one times out
+                wake_up = outstanding[next(iter(outstanding))][2] if outstanding else now + 1
+                if next_probe is not None:
+                    wake_up = min(wake_up, max(next_send, start + next_probe[0] * self.interval))
+                reply = self.receiveOnePing(icmp_socket, wake_up - time())
+                if reply is None:
+                    continue
 
-    def doOnePing(self, destinationAddress, timeout):
-        # 1. Create ICMP socket
-        icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"));
-        # print(icmp_socket)
+                # 4. Match the reply to its probe, duplicates and replies to other processes are ignored
+                probe = outstanding.pop((reply["id"], reply["seq"]), None)
+                if probe is not None:
+                    delay = 1000 * (reply["time"] - probe[1])
+                    self.recordReply(probe[0], delay)
+                    metrics.increment("ping_replies_total")
+                    metrics.observe("ping_rtt_seconds", delay / 1000)
+                    if onResult is not None:
+                        onResult(probe[0], reply["seq"], reply, delay)
+        finally:
+            icmp_socket.close()
 
-        # 2. Call sendOnePing function
-        self.sendOnePing(icmp_socket, destinationAddress, 1)
+    async def monitorAsync(self, targets, timeout, reportInterval):
+        # Pings every target every self.interval seconds until cancelled, as a service of the async runtime.
+        # The raw socket is registered with the event loop and a statistics line per target is printed
+        # every reportInterval seconds.
+        loop = asyncio.get_running_loop()
+        icmp_socket = self.createICMPSocket()
+        icmp_socket.setblocking(False)
+        outstanding = collections.OrderedDict() # (identifier, sequence number) -> [target, send time], oldest first
 
-        # 3. Call receiveOnePing function
-        delay = self.receiveOnePing(icmp_socket, destinationAddress, 1, timeout)
+        def readReplies():
+            while True:
+                try:
+                    packet = icmp_socket.recv(2048)
+                except OSError:
+                    return
+                receiving_time = time()
+                reply = self.parseICMPPacket(packet)
+                if reply is None or reply["type"] != 0:
+                    continue
+                probe = outstanding.pop((reply["id"], reply["seq"]), None)
+                if probe is not None:
+                    self.recordReply(probe[0], 1000 * (receiving_time - probe[1]))
+                    metrics.increment("ping_replies_total")
+                    metrics.observe("ping_rtt_seconds", receiving_time - probe[1])
 
-        # 4. Close ICMP socket
-        icmp_socket.close()
+        loop.add_reader(icmp_socket.fileno(), readReplies)
+        try:
+            sequence_number = 0
+            next_round = next_report = time()
+            next_report += reportInterval
+            while True:
+                # 1. Probes that outlived the timeout are lost
+                now = time()
+                while outstanding and outstanding[next(iter(outstanding))][1] + timeout <= now:
+                    outstanding.popitem(last=False)
+                    metrics.increment("ping_timeouts_total")
 
-        # 5. Return total network delay
-        return delay   
+                # 2. Print the statistics, probes still in flight are not counted as lost yet
+                if now >= next_report:
+                    in_flight = collections.Counter(probe[0]["id"] for probe in outstanding.values())
+                    for target in targets:
+                        self.printTargetLine(dict(target, sent=target["sent"] - in_flight[target["id"]]))
+                    next_report += reportInterval
 
-    def __init__(self, args):
-        print('Ping to: %s...' % (args.hostname))
+                # 3. Send the next round, paced to self.rate requests per second
+                sequence_number = (sequence_number + 1) & 0xffff
+                for target in targets:
+                    try:
+                        icmp_socket.sendto(self.buildEchoRequest(target["id"], sequence_number), (target["address"], 1))
+                    except OSError:
+                        pass # reported as a timeout
+                    target["sent"] += 1
+                    metrics.increment("ping_probes_sent_total")
+                    outstanding[(target["id"], sequence_number)] = [target, time()]
+                    if len(targets) > 1:
+                        await asyncio.sleep(1.0 / self.rate)
 
-        # 1. Look up hostname, resolving it to an IP address
-        ip = socket.gethostbyname(args.hostname)
+                next_round += self.interval
+                await asyncio.sleep(max(0, next_round - time()))
+        finally:
+            loop.remove_reader(icmp_socket.fileno())
+            icmp_socket.close()
 
-        # 2. Call doOnePing function, approximately every second
-        for i in range(4): # 4. Continue this process until stopped 
-            info = self.doOnePing(ip, 5)
-            if (info[0] < 0):
-                print("Timeout")
-                continue
+    def targetStatistics(self, target):
+        # Returns [packet loss, minimum, average, maximum, mean deviation]
+        if target["sent"] == 0:
+            return [0.0, 0.0, 0.0, 0.0, 0.0]
+        packet_loss = 100.0 * (target["sent"] - target["received"]) / target["sent"]
+        if target["received"] == 0:
+            return [packet_loss, 0.0, 0.0, 0.0, 0.0]
+        deviation = math.sqrt(target["m2"] / target["received"])
+        return [packet_loss, target["minimum"], target["mean"], target["maximum"], deviation]
+
+    def printTargetLine(self, target):
+        packet_loss, minimum, average, maximum, deviation = self.targetStatistics(target)
+        print("%-40s %-15s sent=%d received=%d loss=%.2f%% rtt min/avg/max/mdev = %.2f/%.2f/%.2f/%.2f ms p50/p99 = %.2f/%.2f ms"
+              % (target["hostname"], target["address"], target["sent"], target["received"],
+                 packet_loss, minimum, average, maximum, deviation, target["p50"].value(), target["p99"].value()))
+
+    def printOneTarget(self, target, sequenceNumber, reply, delay):
+        if reply is None:
+            print("Timeout")
+        else:
+            self.printOneResult(target["address"], reply["size"] - 8, delay, reply["ttl"])
+
+    def resolveTargets(self, hostnames):
+        base_id = os.getpid() & 0xffff
+        targets = []
+        for hostname, address in self.resolveHostnames(hostnames):
+            targets.append(self.newTarget(hostname, address, (base_id + len(targets)) & 0xffff))
+        return targets
+
+    def __init__(self, args, start=True):
+        self.rate = args.rate
+        self.interval = args.interval
+        if not start:
+            return
+        hostnames = self.readTargets(args)
+        if args.metrics_port:
+            self.serveMetrics(args.metrics_port)
+        if len(hostnames) == 1:
+            print('Ping to: %s...' % (hostnames[0]))
+        else:
+            print('Ping to: %d targets...' % (len(hostnames)))
+
+        # 1. Look up every hostname, resolving it to an IP address
+        targets = self.resolveTargets(hostnames)
+        if not targets:
+            return
+
+        # 2. Ping all targets over one socket, a single target gets a line per probe like the classic ping.
+        # Every result also goes to the time series log and a statistics line per target is printed every
+        # summary interval, which is how a continuous run (count 0) reports until it is interrupted.
+        series = PingSeriesLog(args.log_file, args.log_format) if args.log_file else None
+        next_summary = time() + args.summary_interval
+
+        def onResult(target, sequenceNumber, reply, delay):
+            nonlocal next_summary
+            if len(targets) == 1:
+                self.printOneTarget(target, sequenceNumber, reply, delay)
+            if series is not None:
+                series.write(target, sequenceNumber, delay)
+            if args.summary_interval > 0 and time() >= next_summary:
+                for summaryTarget in targets:
+                    self.printTargetLine(summaryTarget)
+                if series is not None:
+                    series.flush()
+                next_summary += args.summary_interval
+
+        signal.signal(signal.SIGTERM, signal.default_int_handler) # stopped by a service manager like by Ctrl-C
+        try:
+            self.pingTargets(targets, args.count, args.timeout, onResult)
+        except KeyboardInterrupt:
+            pass # a continuous run ends with the statistics below
+        finally:
+            if series is not None:
+                series.close()
 
-            # 3. Print out the returned delay (and other relevant details) using the printOneResult method
-            self.printOneResult(ip, 32, round(info[0]), info[1])
-            sleep(1)
+        # 3. Print the statistics of every target
+        for target in targets:
+            if len(targets) == 1:
+                print("--- %s ping statistics ---" % (target["hostname"]))
+                print("%d packets transmitted, %d received" % (target["sent"], target["received"]))
+                self.printAdditionalDetails(*self.targetStatistics(target))
+                print("rtt p50/p99 = %.2f/%.2f ms" % (target["p50"].value(), target["p99"].value()))
+            else:
+                self.printTargetLine(target)
 
 class Traceroute(NetworkApplication):
+    metric_prefix = "traceroute"
     current_seq_num = 0
     sending_time = 0
     id = 1
+    gap_limit = 5 # silent hops in a row after which a batch trace stops probing forward
 
     def receiveOnePing(self, icmpSocket, destinationAddress, ID, timeout):
         # 1. Wait for the socket to receive a reply
@@ -281,20 +1623,270 @@ class Traceroute(NetworkApplication):
         return delay   
 
 
-    def __init__(self, args):
+    def matchEchoProbe(self, reply):
+        # The destination answers with an echo reply, routers on the way quote our echo request
+        if reply["type"] == 0:
+            return (reply["id"], reply["seq"])
+        quoted = reply["quoted"]
+        if quoted is not None and quoted["protocol"] == socket.IPPROTO_ICMP:
+            return (quoted["id"], quoted["seq"])
+        return None
+
+    def traceParallel(self, destinationAddress, timeout, maxHops, probesPerHop):
+        # Sends probesPerHop echo requests for every ttl up front over one raw socket, so the whole
+        # trace takes about one round trip plus the timeout. Each probe gets its own sequence number.
+        icmp_socket = self.createICMPSocket()
+        ID = os.getpid() & 0xffff
+        probes = {}
+        try:
+            for ttl in range(1, maxHops + 1):
+                icmp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                for probe in range(probesPerHop):
+                    # The echo header has 16 bits for the sequence number, the probes after the first 65536
+                    # go on under the next identifiers so every probe keeps a key of its own
+                    number = ttl * probesPerHop + probe
+                    probe_id, sequence_number = (ID + (number >> 16)) & 0xffff, number & 0xffff
+                    icmp_socket.sendto(self.buildEchoRequest(probe_id, sequence_number), (destinationAddress, 1))
+                    probes[(probe_id, sequence_number)] = [ttl, time()]
+                    metrics.increment("traceroute_probes_sent_total")
+
+            results = self.collectProbeReplies(icmp_socket, probes, timeout, self.matchEchoProbe,
+                                               self.allHopsAnswered(probes, destinationAddress))
+        finally:
+            icmp_socket.close()
+        return [probes, results]
+
+    async def traceAsync(self, destinationAddress, timeout, maxHops, probesPerHop, ID, base=0):
+        # traceParallel as a coroutine, base offsets the sequence numbers so a late reply to an earlier
+        # round of a monitor is not taken for a reply to this one
+        icmp_socket = self.createICMPSocket()
+        icmp_socket.setblocking(False)
+        probes = {}
+        try:
+            for ttl in range(1, maxHops + 1):
+                icmp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                for probe in range(probesPerHop):
+                    sequence_number = (base + ttl * probesPerHop + probe) & 0xffff
+                    icmp_socket.sendto(self.buildEchoRequest(ID, sequence_number), (destinationAddress, 1))
+                    probes[(ID, sequence_number)] = [ttl, time()]
+                    metrics.increment("traceroute_probes_sent_total")
+
+            results = await self.collectProbeRepliesAsync(icmp_socket, probes, timeout, self.matchEchoProbe,
+                                                          self.allHopsAnswered(probes, destinationAddress))
+        finally:
+            icmp_socket.close()
+        return [probes, results]
+
+    def pathChanged(self, previous, current):
+        # A hop that did not answer in one of the two traces is not taken as a change
+        if previous is None or len(previous) != len(current):
+            return True
+        return any(old is not None and new is not None and old != new for old, new in zip(previous, current))
+
+    async def monitorAsync(self, hostname, timeout, maxHops, probesPerHop, interval, ID):
+        # Traces the route to hostname every interval seconds until cancelled, as a service of the async
+        # runtime, and prints the hop table the first time and whenever the path changes
+        addresses = await asyncio.get_running_loop().getaddrinfo(hostname, None, family=socket.AF_INET, type=socket.SOCK_RAW)
+        destination_address = addresses[0][4][0]
+        path = None
+        round_number = 0
+        while True:
+            started = time()
+            probes, results = await self.traceAsync(destination_address, timeout, maxHops, probesPerHop, ID,
+                                                    round_number * (maxHops + 1) * probesPerHop)
+            round_number += 1
+            hops = self.hopAddresses(probes, results, destination_address, maxHops)
+            if self.pathChanged(path, hops):
+                print("%s: route to %s (%s)%s" % (ctime(), hostname, destination_address, " changed" if path is not None else ""))
+                self.printHopTable(probes, results, destination_address, maxHops)
+            path = hops
+            await asyncio.sleep(max(0, started + interval - time()))
+
+    def newTrace(self, hostname, address, startTTL):
+        # hops maps ttl -> [address, rtt in ms, cached] or None for a hop that did not answer
+        return {"hostname": hostname, "address": address, "hops": {}, "ttl": startTTL, "start": startTTL,
+                "forward": True, "gap": 0, "step": 0, "unsent": 0, "in_flight": 0, "probes": 0, "started": time()}
+
+    def advanceTrace(self, trace, result, maxHops):
+        # Records the answer to the current hop and moves the trace to the next one, returns False once it is
+        # complete. Forward probing ends at the destination, maxHops or gap_limit silent hops, backward probing
+        # at ttl 1 or at an address already found at the same ttl, whose path is copied from the hop cache.
+        ttl = trace["ttl"]
+        trace["hops"][ttl] = result
+        address = result[0] if result is not None else None
+        if trace["forward"]:
+            trace["gap"] = 0 if result is not None else trace["gap"] + 1
+            if address == trace["address"] or ttl >= maxHops or trace["gap"] >= self.gap_limit:
+                trace["forward"] = False
+                trace["ttl"] = trace["start"] - 1
+            else:
+                trace["ttl"] = ttl + 1
+        else:
+            prefix = self.hop_cache.get((address, ttl)) if address is not None else None
+            if prefix is not None:
+                for hop_ttl, hop in enumerate(prefix, 1):
+                    trace["hops"][hop_ttl] = None if hop is None else [hop[0], hop[1], True]
+                trace["ttl"] = 0
+            else:
+                trace["ttl"] = ttl - 1
+        trace["step"] += 1
+        trace["unsent"] = trace["in_flight"] = 0
+        return trace["ttl"] > 0
+
+    def finishTrace(self, trace):
+        # The path ends at the first ttl the destination answered from, or at the last hop that answered, and
+        # every hop on it is added to the hop cache for the traces that follow
+        reached = [ttl for ttl, hop in trace["hops"].items() if hop is not None and hop[0] == trace["address"]]
+        answered = [ttl for ttl, hop in trace["hops"].items() if hop is not None]
+        last_hop = min(reached) if reached else max(answered, default=0)
+        path = [trace["hops"].get(ttl) for ttl in range(1, last_hop + 1)]
+        for ttl, hop in enumerate(path, 1):
+            if hop is not None and hop[0] != trace["address"]:
+                self.hop_cache.setdefault((hop[0], ttl), path[:ttl - 1])
+        trace["path"] = path
+        trace["reached"] = bool(reached)
+
+    def traceBatch(self, targets, timeout, maxHops, probesPerHop, startTTL, concurrency, onTrace):
+        # Traces many destinations at once over one raw socket, paced to self.rate probes per second overall.
+        # Like Doubletree, a trace starts at startTTL, probes forward one hop at a time and then backward
+        # until it meets a hop an earlier trace already found, so the hops near this host, which most traces
+        # share, are only probed once. Every hop gets
+        # probesPerHop probes and is answered by the first reply. onTrace(trace) is called as each one finishes.
+        icmp_socket = self.createICMPSocket()
+        ID = os.getpid() & 0xffff
+        sequence_number = 0
+        waiting = collections.deque(targets)
+        ready = collections.deque() # traces with probes of their current hop left to send
+        outstanding = collections.OrderedDict() # (identifier, sequence number) -> [trace, step, send time, deadline], oldest first
+        active = finished = 0
+        next_send = time()
+
+        def hopDone(trace, result):
+            nonlocal active, finished
+            if self.advanceTrace(trace, result, maxHops):
+                trace["unsent"] = probesPerHop
+                ready.append(trace)
+            else:
+                active -= 1
+                finished += 1
+                self.finishTrace(trace)
+                onTrace(trace)
+
+        try:
+            while waiting or active:
+                # 1. Start new traces, the first one alone so that the others find its hops in the cache
+                now = time()
+                while waiting and active < (concurrency if finished else 1):
+                    hostname, address = waiting.popleft()
+                    trace = self.newTrace(hostname, address, min(startTTL, maxHops))
+                    trace["unsent"] = probesPerHop
+                    ready.append(trace)
+                    active += 1
+
+                # 2. Send the probes that are due, a trace whose hop was answered meanwhile sends no more
+                if not ready:
+                    next_send = max(next_send, now)
+                while ready and next_send <= now:
+                    trace = ready[0]
+                    if trace["unsent"] == 0:
+                        ready.popleft()
+                        continue
+                    sequence_number = (sequence_number + 1) & 0xffff
+                    icmp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, trace["ttl"])
+                    try:
+                        icmp_socket.sendto(self.buildEchoRequest(ID, sequence_number), (trace["address"], 1))
+                    except OSError:
+                        pass # reported as a timeout
+                    sending_time = time()
+                    outstanding[(ID, sequence_number)] = [trace, trace["step"], sending_time, sending_time + timeout]
+                    metrics.increment("traceroute_probes_sent_total")
+                    trace["probes"] += 1
+                    trace["in_flight"] += 1
+                    trace["unsent"] -= 1
+                    if trace["unsent"] == 0:
+                        ready.popleft()
+                    next_send += 1.0 / self.rate
+
+                # 3. Probes that outlived the timeout are lost, a hop is silent once all of its probes are
+                while outstanding:
+                    key, probe = next(iter(outstanding.items()))
+                    if probe[3] > now:
+                        break
+                    del outstanding[key]
+                    metrics.increment("traceroute_timeouts_total")
+                    trace = probe[0]
+                    if probe[1] == trace["step"]:
+                        trace["in_flight"] -= 1
+                        if trace["in_flight"] == 0 and trace["unsent"] == 0:
+                            hopDone(trace, None)
+
+                # 4. Wait for a reply until the next probe is due or the oldest one times out
+                wake_up = outstanding[next(iter(outstanding))][3] if outstanding else now + 1
+                if ready:
+                    wake_up = min(wake_up, next_send)
+                if not select.select([icmp_socket], [], [], max(0, wake_up - time()))[0]:
+                    continue
+                packet = icmp_socket.recv(2048)
+                receiving_time = time()
+                reply = self.parseICMPPacket(packet)
+                probe = outstanding.pop(self.matchEchoProbe(reply), None) if reply is not None else None
+                if probe is None:
+                    continue
+                metrics.increment("traceroute_replies_total")
+                metrics.observe("traceroute_rtt_seconds", receiving_time - probe[2])
+                if probe[1] == probe[0]["step"]:
+                    hopDone(probe[0], [reply["source"], 1000 * (receiving_time - probe[2]), False])
+        finally:
+            icmp_socket.close()
+
+    def printTraceRecord(self, trace):
+        # One JSON line per finished trace, flushed at once so the results can be read as they come
+        hops = [{"ttl": ttl, "address": hop[0] if hop else None, "rtt": round(hop[1], 3) if hop else None,
+                 "cached": hop[2] if hop else False} for ttl, hop in enumerate(trace["path"], 1)]
+        print(json.dumps({"hostname": trace["hostname"], "address": trace["address"], "reached": trace["reached"],
+                          "hops": hops, "probes": trace["probes"], "seconds": round(time() - trace["started"], 3)}),
+              flush=True)
+
+    def __init__(self, args, start=True):
+        if not start:
+            return
+        hostnames = self.readTargets(args)
+        if args.metrics_port:
+            self.serveMetrics(args.metrics_port)
+        if len(hostnames) != 1 or args.targets_file:
+            # Batch mode, a JSON line per trace on standard output and the progress on standard error
+            print('Traceroute to: %d targets...' % (len(hostnames)), file=sys.stderr)
+            self.rate = args.rate
+            self.hop_cache = {} # (address, ttl) -> hops from ttl 1 to the one before it
+            self.traceBatch(self.resolveHostnames(hostnames), args.timeout, args.max_hops, args.probes,
+                            args.start_ttl, args.concurrency, self.printTraceRecord)
+            print("Trace complete.", file=sys.stderr)
+            return
+        args.hostname = hostnames[0]
+
         # Please ensure you print each result using the printOneResult method!
         print('Traceroute to: %s...' % (args.hostname))
 
         # 1. Look up hostname, resolving it to an IP address
         dest_ip = socket.gethostbyname(args.hostname)
 
+        if args.parallel:
+            probes, results = self.traceParallel(dest_ip, args.timeout, args.max_hops, args.probes)
+            self.printHopTable(probes, results, dest_ip, args.max_hops)
+            print("Trace complete.")
+            return
+
         ttl_count = 1
         hop_id = -1
-        while dest_ip != hop_id and ttl_count < 30:
+        while dest_ip != hop_id and ttl_count <= args.max_hops:
             info = self.doOnePing(dest_ip, args.timeout, ttl_count)
+            metrics.increment("traceroute_probes_sent_total")
             if info == -1:
+                metrics.increment("traceroute_timeouts_total")
                 print("* * *")
             else:
+                metrics.increment("traceroute_replies_total")
+                metrics.observe("traceroute_rtt_seconds", info[0] / 1000)
                 hop_id = socket.inet_ntoa(info[1]) # this converts the binary value of the ip address to a readable string representing the ip 
                 self.printOneResult(hop_id, 32, round(info[0]), ttl_count)
             
@@ -304,10 +1896,14 @@ class Traceroute(NetworkApplication):
 
 
 class ParisTraceroute(NetworkApplication):
+    metric_prefix = "paris"
     source_port = 33457
     destination_port = 33456 
     sendingTime = None
     cur_checksum = 0
+    flow_checksum = 0xff76 # UDP checksum shared by every probe of a parallel trace
+    stopping_points = {} # (successors, alpha) -> flows, see stoppingPoint
+    probe_attempts = 3 # probes sent to a (ttl, flow) before multipath mode counts it as a star
 
     def createSendingSocket(self, hostname, ttl): # This is a UDP Socket
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname("UDP"))
@@ -351,18 +1947,241 @@ class ParisTraceroute(NetworkApplication):
         for cur_socket in socket:
             cur_socket.close()
     
-    def __init__(self, args):
-        print("Paris-Traceroute to: %s..." % (args.hostname))
+    def probePayload(self, sourceAddress, destinationAddress, probeID, destinationPort=None):
+        # Paris traceroute keeps every header field load balancers hash on constant, the UDP checksum included.
+        # Probes are told apart by their length instead, which routers quote back in their ICMP errors and
+        # NATs never rewrite. The first 2 payload bytes are chosen so the kernel computes flow_checksum,
+        # the zero padding after them does not change the sum.
+        length = 8 + 2 + probeID
+        words = struct.unpack("!6H", socket.inet_aton(sourceAddress) + socket.inet_aton(destinationAddress) +
+                              struct.pack("!HH", socket.IPPROTO_UDP, length))
+        words += (self.source_port, destinationPort or self.destination_port, length)
+        total = sum(words)
+        while total >> 16:
+            total = (total & 0xffff) + (total >> 16)
+
+        # flow_checksum = ~(total + word) in ones' complement arithmetic, so word = ~flow_checksum - total
+        word = ((~self.flow_checksum) & 0xffff) + ((~total) & 0xffff)
+        while word >> 16:
+            word = (word & 0xffff) + (word >> 16)
+        return struct.pack("!H", word) + bytes(probeID)
+
+    def matchUDPProbe(self, reply):
+        quoted = reply["quoted"]
+        if quoted is None or quoted["protocol"] != socket.IPPROTO_UDP:
+            return None
+        if quoted["source_port"] != self.source_port or quoted["destination_port"] != self.destination_port:
+            return None
+        return quoted["length"] - 8 - 2
+
+    def flowPort(self, flow):
+        # Destination port of a multipath flow, the ports count up from destination_port and skip source_port,
+        # a probe sent to it would reach the probes' own socket when tracing this host
+        port = self.destination_port + flow
+        return port + 1 if self.destination_port <= self.source_port <= port else port
+
+    def portFlow(self, port):
+        # The flow identifier flowPort gave the destination port
+        flow = port - self.destination_port
+        return flow - 1 if self.destination_port <= self.source_port < port else flow
+
+    def matchFlowProbe(self, reply):
+        # Multipath probes are keyed by (ttl, flow), the ttl is carried in the UDP length and the flow
+        # identifier in the destination port
+        quoted = reply["quoted"]
+        if quoted is None or quoted["protocol"] != socket.IPPROTO_UDP or quoted["source_port"] != self.source_port:
+            return None
+        return (quoted["length"] - 8 - 2, self.portFlow(quoted["destination_port"]))
+
+    def stoppingPoint(self, successors, alpha):
+        # Number of flows sent through an interface after which, if only `successors` next hops were seen,
+        # one more next hop (all of them taking an equal share of the flows) would have been missed with
+        # probability at most alpha. The miss probability comes from inclusion-exclusion over the next hops.
+        key = (successors, alpha)
+        if key not in self.stopping_points:
+            branches = successors + 1
+            flows = branches
+            while sum((-1) ** (i + 1) * math.comb(branches, i) * ((branches - i) / branches) ** flows
+                      for i in range(1, branches)) > alpha:
+                flows += 1
+            self.stopping_points[key] = flows
+        return self.stopping_points[key]
+
+    def traceMultipath(self, destinationAddress, timeout, maxHops, confidence, maxFlows):
+        # Multipath detection algorithm (Augustin et al., 2006). Hop by hop, every interface found at the
+        # previous hop is sent new flow identifiers (destination ports) until the stopping point for the
+        # next hops found behind it is reached. When too few known flows go through an interface, new flows
+        # are first probed at the previous hop. The probes of a round are all in flight at once over one UDP
+        # and one ICMP socket. Returns [hops, probes sent], hops[ttl - 1] maps flow -> [address or None, rtt in ms].
+        alpha = (1 - confidence / 100) / maxHops # the failure probability is split evenly over the hops
+        route_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        route_socket.connect((destinationAddress, self.destination_port))
+        source_address = route_socket.getsockname()[0]
+        route_socket.close()
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp_socket.bind(("0.0.0.0", self.source_port))
+        icmp_socket = self.createRecevingScoket()
+        hops = [{}] # hops[0] is this host, which every flow goes through
+        attempts = collections.Counter() # (ttl, flow) -> probes sent, a star is retried in later rounds
+        next_flow = 0
+
+        def settled(hopTTL, flow):
+            result = hops[hopTTL].get(flow)
+            return result is not None and (result[0] is not None or attempts[(hopTTL, flow)] >= self.probe_attempts)
+
+        try:
+            for ttl in range(1, maxHops + 1):
+                hops.append({})
+                controlled = {} # interface -> flows reaching it when new flows were last sent towards it
+                while True:
+                    # 1. Every interface of the previous hop gets flows up to the stopping point of its next hops,
+                    # routers rate limit their ICMP errors so a star only counts once its retries are used up
+                    interfaces = collections.defaultdict(list)
+                    for flow, result in hops[ttl - 1].items():
+                        if result[0] != destinationAddress or ttl == 1:
+                            interfaces[result[0]].append(flow)
+                    if ttl == 1 and not interfaces:
+                        interfaces[source_address] = []
+                    answered = sum(1 for result in hops[ttl - 1].values() if result[0] is not None)
+                    batch = {}
+                    for interface, flows in interfaces.items():
+                        done = [flow for flow in flows if settled(ttl, flow)]
+                        successors = {hops[ttl][flow][0] for flow in done} - {None}
+                        missing = self.stoppingPoint(max(1, len(successors)), alpha) - len(done)
+                        waiting = [flow for flow in flows if not settled(ttl, flow)][:max(0, missing)]
+                        batch.update(((ttl, flow), None) for flow in waiting)
+                        missing -= len(waiting)
+                        if missing <= 0 or interface is None:
+                            continue
+
+                        # 2. Not enough known flows reach the interface, stars of the previous hop are retried
+                        # and new flows are sent to it in proportion to the share of flows the interface gets.
+                        # An interface that got no new flow from the last attempt is given up on.
+                        if ttl == 1:
+                            new_flows = min(missing, maxFlows - next_flow)
+                            for flow in range(next_flow, next_flow + new_flows):
+                                hops[0][flow] = [source_address, 0.0]
+                        else:
+                            stars = [flow for flow in hops[ttl - 1] if not settled(ttl - 1, flow)]
+                            if not stars and len(flows) <= controlled.get(interface, -1):
+                                continue
+                            controlled[interface] = len(flows)
+                            batch.update(((ttl - 1, flow), None) for flow in stars)
+                            new_flows = math.ceil(missing * answered / len(flows)) - len(stars)
+                            new_flows = max(0, min(new_flows, maxFlows - next_flow))
+                        batch.update(((max(1, ttl - 1), flow), None) for flow in range(next_flow, next_flow + new_flows))
+                        next_flow += new_flows
+                    if not batch:
+                        break
+
+                    # 3. Send the round at once and wait for its replies
+                    probes = {}
+                    for key in sorted(batch):
+                        udp_socket.setsockopt(socket.SOL_IP, socket.IP_TTL, key[0])
+                        port = self.flowPort(key[1])
+                        udp_socket.sendto(self.probePayload(source_address, destinationAddress, key[0], port),
+                                          (destinationAddress, port))
+                        probes[key] = [key[0], time()]
+                        attempts[key] += 1
+                        metrics.increment("paris_probes_sent_total")
+                    results = self.collectProbeReplies(icmp_socket, probes, timeout, self.matchFlowProbe)
+                    for key in batch:
+                        result = results.get(key)
+                        if result is None:
+                            metrics.increment("paris_timeouts_total")
+                        hops[key[0]][key[1]] = [result[0], result[1]] if result is not None else [None, None]
+
+                # 4. The trace ends once every flow that got a reply at this hop reached the destination
+                addresses = {result[0] for result in hops[ttl].values()} - {None}
+                if addresses and addresses <= {destinationAddress}:
+                    break
+        finally:
+            udp_socket.close()
+            icmp_socket.close()
+        return [hops[1:], sum(attempts.values())]
+
+    def printMultipath(self, hops, probesSent):
+        # One line per hop with every interface found, the flows that reached it and their average rtt,
+        # then the links between interfaces of consecutive hops that were seen on a common flow
+        for ttl, hop in enumerate(hops, 1):
+            interfaces = collections.defaultdict(list)
+            for result in hop.values():
+                interfaces[result[0]].append(result[1])
+            line = ["%s (%d flows, %.3f ms)" % (address, len(rtts), sum(rtts) / len(rtts))
+                    for address, rtts in interfaces.items() if address is not None]
+            if None in interfaces:
+                line.append("* (%d flows)" % (len(interfaces[None])))
+            print("%d  %s" % (ttl, "  ".join(line)))
+
+        print("Links:")
+        for ttl in range(1, len(hops)):
+            links = collections.Counter((hops[ttl - 1][flow][0], result[0]) for flow, result in hops[ttl].items()
+                                        if flow in hops[ttl - 1] and hops[ttl - 1][flow][0] is not None and result[0] is not None)
+            for (source, destination), flows in sorted(links.items()):
+                print("%d  %s -> %s (%d flows)" % (ttl, source, destination, flows))
+        print("%d probes sent over %d flows" % (probesSent, len(set().union(*hops))))
+
+    def sendProbe(self, udpSocket, payload):
+        # A port unreachable answered to an earlier probe is reported on the next send of a connected socket
+        # instead of sending, and reporting it clears it. More can arrive in between, so send until it goes out.
+        while True:
+            try:
+                return udpSocket.send(payload)
+            except ConnectionRefusedError:
+                pass
+
+    def traceParallel(self, destinationAddress, timeout, maxHops, probesPerHop):
+        # All ttls are probed at once from a single UDP socket, the flow identifier never changes
+        # and each probe is identified by its UDP length which routers quote back in their ICMP errors
+        udp_socket = self.createSendingSocket(destinationAddress, 1)
+        icmp_socket = self.createRecevingScoket()
+        source_address = udp_socket.getsockname()[0]
+        probes = {}
+        try:
+            for ttl in range(1, maxHops + 1):
+                udp_socket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl)
+                for probe in range(probesPerHop):
+                    probe_id = (ttl - 1) * probesPerHop + probe
+                    self.sendProbe(udp_socket, self.probePayload(source_address, destinationAddress, probe_id))
+                    probes[probe_id] = [ttl, time()]
+                    metrics.increment("paris_probes_sent_total")
+
+            results = self.collectProbeReplies(icmp_socket, probes, timeout, self.matchUDPProbe,
+                                               self.allHopsAnswered(probes, destinationAddress))
+        finally:
+            udp_socket.close()
+            icmp_socket.close()
+        return [probes, results]
+
+    def __init__(self, args):
+        print("Paris-Traceroute to: %s..." % (args.hostname))
+        if args.metrics_port:
+            self.serveMetrics(args.metrics_port)
         dest_ip = socket.gethostbyname(args.hostname)
 
-        for ttl in range(1, 30):
+        if args.multipath:
+            hops, probes_sent = self.traceMultipath(dest_ip, args.timeout, args.max_hops, args.confidence, args.max_flows)
+            self.printMultipath(hops, probes_sent)
+            return
+
+        if args.parallel:
+            probes, results = self.traceParallel(dest_ip, args.timeout, args.max_hops, args.probes)
+            self.printHopTable(probes, results, dest_ip, args.max_hops)
+            return
+
+        for ttl in range(1, args.max_hops + 1):
             udp_socket = self.createSendingSocket(dest_ip, ttl)
             icmp_socket = self.createRecevingScoket()
             self.sendOnePing(udp_socket, dest_ip, ttl)
             packet_info = self.receiveOnePing(icmp_socket, None, None, args.timeout)
+            metrics.increment("paris_probes_sent_total")
             if packet_info == None:
+                metrics.increment("paris_timeouts_total")
                 print("* * *")
             else:
+                metrics.increment("paris_replies_total")
+                metrics.observe("paris_rtt_seconds", packet_info[0] / 1000)
                 hop_id = socket.inet_ntoa(packet_info[1])
                 # print(packet_info[0], hop_id)
                 self.printOneResult(hop_id, 2, round(packet_info[0]), ttl)
@@ -370,130 +2189,2333 @@ class ParisTraceroute(NetworkApplication):
                     break
 
 
+class Stream:
+    # One connection as seen by the request paths the threads and asyncio modes share, every method is
+    # awaited. SocketStream implements it over a blocking socket and AsyncStream over an asyncio stream pair.
+    # Reads go through a buffer kept here, so bytes read past the end of a message can be given back.
+    chunk_size = 65536 # bytes copied per step by relay
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.pending = bytearray()
+
+    async def read(self, size):
+        # Up to size bytes as soon as any are available, b"" at end of file
+        if self.pending:
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+            return data
+        return await self.receive(size)
+
+    async def readline(self, limit):
+        # One line including its newline, at most limit bytes, or what is left at end of file
+        while True:
+            end = self.pending.find(b"\n", 0, limit)
+            if end >= 0 or len(self.pending) >= limit:
+                size = end + 1 if end >= 0 else limit
+                line = bytes(self.pending[:size])
+                del self.pending[:size]
+                return line
+            data = await self.receive(self.chunk_size)
+            if not data:
+                line = bytes(self.pending)
+                self.pending.clear()
+                return line
+            self.pending += data
+
+    async def fill(self):
+        # Appends the next received bytes to the buffer for a parser to look at, False at end of file
+        data = await self.receive(self.chunk_size)
+        self.pending += data
+        return bool(data)
+
+    def unread(self, data):
+        self.pending[:0] = data
+
+
+class SocketStream(Stream):
+    # Stream over a blocking socket for the threads mode. Its coroutine methods never suspend, they block the
+    # calling thread, so runToCompletion runs a request path over it like plain socket code.
+    def __init__(self, connection, timeout=None):
+        super().__init__(timeout)
+        self.socket = connection
+        self.socket.settimeout(timeout)
+
+    async def receive(self, size):
+        return self.socket.recv(size)
+
+    async def write(self, data):
+        self.socket.sendall(data)
+
+    async def sendFile(self, file):
+        # socket.sendfile uses os.sendfile, so the kernel copies the file
+        return self.socket.sendfile(file)
+
+    async def relay(self, other, counted):
+        # Full-duplex copy with other until both sides finished sending or neither sent anything for the
+        # timeout, a side that finishes has its write half shut down on the other connection. counted gets
+        # the size of everything written to this connection.
+        if self.pending:
+            await other.write(await self.read(len(self.pending)))
+        peers = {self.socket: other.socket, other.socket: self.socket}
+        open_sockets = [self.socket, other.socket]
+        while open_sockets:
+            readable = select.select(open_sockets, [], [], self.timeout)[0]
+            if not readable:
+                return
+            for source in readable:
+                data = source.recv(self.chunk_size)
+                if data:
+                    peers[source].sendall(data)
+                    if source is other.socket:
+                        counted(len(data))
+                else:
+                    open_sockets.remove(source)
+                    peers[source].shutdown(socket.SHUT_WR)
+
+    def peer(self):
+        return self.socket.getpeername()[0]
+
+    def isUsable(self):
+        # An idle keep-alive connection must have nothing to read, readable means the peer closed it or sent garbage
+        try:
+            readable = select.select([self.socket], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+        return not readable and not self.pending
+
+    def close(self):
+        self.socket.close()
+
+
+class AsyncStream(Stream):
+    # Stream over an asyncio (reader, writer) pair for the async runtime, a timeout raises socket.timeout
+    # like a SocketStream does
+    def __init__(self, reader, writer, timeout=None):
+        super().__init__(timeout)
+        self.reader = reader
+        self.writer = writer
+
+    async def wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+
+    async def receive(self, size):
+        return await self.wait(self.reader.read(size))
+
+    async def write(self, data):
+        # The transport may keep what it is given, so a memory mapped range is copied a chunk at a time
+        if isinstance(data, memoryview):
+            for offset in range(0, len(data), self.chunk_size):
+                self.writer.write(bytes(data[offset:offset + self.chunk_size]))
+                await self.wait(self.writer.drain())
+            return
+        self.writer.write(data)
+        await self.wait(self.writer.drain())
+
+    async def sendFile(self, file):
+        # loop.sendfile uses os.sendfile once what was written before has been flushed
+        await self.wait(self.writer.drain())
+        return await asyncio.get_running_loop().sendfile(self.writer.transport, file)
+
+    async def relay(self, other, counted):
+        # relay of SocketStream, each direction is copied by its own coroutine
+        async def pipe(source, target):
+            while True:
+                if source.pending:
+                    data = await source.read(self.chunk_size)
+                else:
+                    data = await source.reader.read(self.chunk_size) # a tunnel may stay quiet for longer than the timeout
+                if not data:
+                    if target.writer.can_write_eof():
+                        target.writer.write_eof()
+                    return
+                target.writer.write(data)
+                await target.writer.drain()
+                if target is self:
+                    counted(len(data))
+
+        await asyncio.gather(pipe(self, other), pipe(other, self))
+
+    def peer(self):
+        return self.writer.get_extra_info("peername")[0]
+
+    def isUsable(self):
+        # Like for a SocketStream an idle connection must have nothing to read. The transport moves what arrives
+        # into the reader's buffer straight away, so that buffer is looked at rather than the socket.
+        if self.pending or self.reader.at_eof() or self.writer.is_closing():
+            return False
+        return not self.reader._buffer
+
+    def close(self):
+        self.writer.close()
+
+
+class HotFileCache:
+    # In memory LRU cache of small file bodies and their precomputed headers, bounded by a byte budget.
+    # An entry is only used while the os.stat mtime and size of the file still match the cached ones.
+    def __init__(self, maxBytes):
+        self.max_bytes = maxBytes
+        self.max_entry_size = maxBytes // 16 # a single large file should not flush the whole cache
+        self.entries = collections.OrderedDict()
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, path, fileStat):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None
+            if entry["mtime"] != fileStat.st_mtime_ns or entry["size"] != fileStat.st_size:
+                self.remove(path)
+                return None
+            self.entries.move_to_end(path)
+            return entry
+
+    def store(self, path, entry):
+        if entry["size"] > self.max_entry_size:
+            return
+        with self.lock:
+            if path in self.entries:
+                self.remove(path)
+            self.entries[path] = entry
+            self.used_bytes += entry["size"]
+
+            # Evict the least recently used entries until the cache fits in its budget again
+            while self.used_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, path):
+        entry = self.entries.pop(path)
+        self.used_bytes -= entry["size"]
+
+
+class DocumentIndex:
+    # In memory index of the document root: request path -> local path, os.stat result and precomputed headers
+    # of every regular file, a directory path maps to the entry of its index file. The tree is scanned once at
+    # startup and then stat'ed again every refreshInterval seconds by a thread, entries of unchanged files are
+    # kept, and the new dictionary replaces the old one in a single assignment so lookups never take a lock.
+    def __init__(self, root, indexFiles, describe, refreshInterval):
+        self.root = root
+        self.index_files = indexFiles
+        self.describe = describe # describe(localPath, fileStat) -> response headers
+        self.refresh_interval = refreshInterval
+        self.entries = {}
+        self.scan()
+
+    def scan(self):
+        entries = {}
+        for directory, subdirectories, files in os.walk(self.root):
+            relative = os.path.relpath(directory, self.root).replace(os.sep, "/")
+            prefix = "/" if relative == "." else "/" + relative + "/"
+            for name in files:
+                local_path = os.path.join(directory, name)
+                try:
+                    file_stat = os.stat(local_path)
+                except OSError:
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                entry = self.entries.get(prefix + name)
+                if entry is None or entry["stat"].st_mtime_ns != file_stat.st_mtime_ns or entry["stat"].st_size != file_stat.st_size:
+                    entry = {"path": local_path, "stat": file_stat, "headers": self.describe(local_path, file_stat)}
+                entries[prefix + name] = entry
+            for name in self.index_files:
+                if prefix + name in entries:
+                    entries[prefix] = entries[prefix + name]
+                    break
+        self.entries = entries
+        metrics.increment("web_index_scans_total")
+
+    def lookup(self, urlPath):
+        return self.entries.get(urlPath)
+
+    def start(self):
+        # Started in every process that serves, after the fork of the workers, threads do not survive a fork
+        def refresh():
+            while True:
+                sleep(self.refresh_interval)
+                try:
+                    self.scan()
+                except OSError as error:
+                    log.write("warning", "Index refresh failed: %s", error)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
 class WebServer(NetworkApplication):
-    def handleRequest(self, tcpSocket):
-        # 1. Receive request message from the client on connection socket
-        request = tcpSocket.recv(1024)
-        print(request)
-
-        # 2. Extract the path of the requested object from the message (second part of the HTTP header)
-        file_path = request.split()[1].decode() # default seperator is white space 
-        print(request.split())
- 
-        # 3. Read the corresponding file from disk
-        outputdata = ""
-        response = ""
-        try:
-            file = open(file_path[1:], "r")
-            
-            # 4. Store in temporary buffer
-            outputdata = file.read().encode() # convert string to binary 
-            file.close()
+    metric_prefix = "web"
+    chunk_size = 65536 # bytes read per step when a file cannot be handed to sendfile
+    keep_alive_timeout = 5 # seconds an idle persistent connection is kept open
+    max_requests = 100 # requests served on one connection before it is closed
+    max_body_size = 1024 * 1024 # files are only read, so larger request bodies are refused with a 413
+    cache = None
+    index = None # DocumentIndex of the root when it is scanned at startup
+    root = "." # directory request paths are relative to
+    index_files = ("index.html", "index.htm") # served for a path naming a directory
+
+    def responseHeader(self, status, headers=(), keepAlive=False):
+        header = "HTTP/1.1 %s\r\n" % (status)
+        for name, value in headers:
+            header += "%s: %s\r\n" % (name, value)
+        if keepAlive:
+            header += "Connection: keep-alive\r\nKeep-Alive: timeout=%d, max=%d\r\n\r\n" % (self.keep_alive_timeout, self.max_requests)
+        else:
+            header += "Connection: close\r\n\r\n"
+        return header.encode()
 
-            response = "HTTP/1.1 200 OK\r\n\r\n".encode()
-        except FileNotFoundError:
-            print("File Not Found")
-            response = "HTTP/1.1 404 Not Found\r\n\r\n".encode()
+    def errorResponse(self, status, keepAlive=False, headers=()):
+        return [self.responseHeader(status, [("Content-Length", 0)] + list(headers), keepAlive), None]
 
-        # 5. Send the correct HTTP response error
-        tcpSocket.sendall(response)
+    def parseErrorStatus(self, error):
+        return "413 Payload Too Large" if isinstance(error, RequestTooLargeError) else "400 Bad Request"
 
-        # 6. Send the content of the file to the socket
-        tcpSocket.sendall(outputdata)
+    def wantsKeepAlive(self, request):
+        # HTTP/1.1 connections are persistent unless the client asks to close, HTTP/1.0 ones only if it asks to keep them
+        connection = request["headers"].get("connection", "").lower()
+        if request["version"] == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
 
-        tcpSocket.close()
+    def fileHeaders(self, filePath, fileStat):
+        # Validators and entity headers describing one version of a file, they only change with its mtime or size
+        return [("Content-Type", mimetypes.guess_type(filePath)[0] or "application/octet-stream"),
+                ("Content-Length", fileStat.st_size),
+                ("ETag", '"%x-%x"' % (fileStat.st_mtime_ns, fileStat.st_size)),
+                ("Last-Modified", email.utils.formatdate(fileStat.st_mtime, usegmt=True)),
+                ("Accept-Ranges", "bytes")]
 
-    def __init__(self, args):
-        print('Web Server starting on port: %i...' % (args.port))
-        # 1. Create server socket
-        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def normalizePath(self, path):
+        # Percent-decodes the request path and resolves its . and .. segments, so it can never name anything
+        # above the root. The final slash of a directory path is kept. None for a path that is not usable.
+        path = urllib.parse.unquote(path)
+        if not path.startswith("/") or "\0" in path or "\\" in path:
+            return None
+        normalized = posixpath.normpath(path)
+        if normalized.startswith("//"):
+            normalized = "/" + normalized.lstrip("/")
+        if path.endswith("/") and normalized != "/":
+            normalized += "/"
+        return normalized
 
-        # 2. Bind the server socket to server address and server port
-        serverSocket.bind(("localhost", args.port)) # I need to extract the server port from args
+    def statPath(self, urlPath):
+        # Returns [local path, os.stat] of the file a normalized request path names, a directory is answered by
+        # its index file. Raises IsADirectoryError for a directory named without its final slash.
+        local_path = os.path.join(self.root, urlPath[1:])
+        file_stat = os.stat(local_path)
+        if stat.S_ISDIR(file_stat.st_mode):
+            if not urlPath.endswith("/"):
+                raise IsADirectoryError(urlPath)
+            for name in self.index_files:
+                try:
+                    index_stat = os.stat(os.path.join(local_path, name))
+                except FileNotFoundError:
+                    continue
+                if stat.S_ISREG(index_stat.st_mode):
+                    return [os.path.join(local_path, name), index_stat]
+            raise FileNotFoundError(urlPath)
+        if not stat.S_ISREG(file_stat.st_mode):
+            raise FileNotFoundError(urlPath)
+        return [local_path, file_stat]
 
-        # 3. Continuously listen for connections to server socket
-        serverSocket.listen()
+    def requestedRange(self, request, size, etag, lastModified):
+        # [first byte, last byte] asked for by a single range Range header (RFC 9110 section 14), None to send
+        # the whole file when there is none, it is malformed or asks for several ranges, or its If-Range no
+        # longer matches. A first byte at or past the end of the file is for the caller to answer with 416.
+        value = request["headers"].get("range", "").strip()
+        if not value.startswith("bytes=") or "," in value:
+            return None
+        if_range = request["headers"].get("if-range")
+        if if_range is not None and if_range.strip() not in (etag, lastModified):
+            return None
+        first, separator, last = value[6:].strip().partition("-")
+        if not separator or not (first + last).isascii(): # str.isdigit also accepts digits int() rejects, like ²
+            return None
+        if not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            if last == "":
+                return None
+            return [max(0, size - int(last)), size - 1] # the last bytes of the file
+        if last != "" and int(last) < int(first):
+            return None
+        return [int(first), min(int(last), size - 1) if last != "" else size - 1]
+
+    def closeBody(self, body):
+        # A body is an open file or a memoryview of a memory mapped range of one
+        if isinstance(body, memoryview):
+            mapping = body.obj
+            body.release()
+            mapping.close()
+        else:
+            body.close()
+
+    def isNotModified(self, request, fileStat, etag):
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110 section 13.2.2)
+        if_none_match = request["headers"].get("if-none-match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+        if_modified_since = request["headers"].get("if-modified-since")
+        if if_modified_since is not None:
+            try:
+                return int(fileStat.st_mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def buildResponse(self, request, keepAlive=False):
+        # The response is the header bytes and, for an uncached 200 GET, the still unread file the body comes from
+        # or, for an uncached 206, a memoryview of the range. Cached bodies are appended to the header so they go
+        # out in the same send.
+        # 1. Only GET and HEAD are supported, the path is the second part of the request line
+        if request["method"] not in ("GET", "HEAD"):
+            return self.errorResponse("405 Method Not Allowed", keepAlive, [("Allow", "GET, HEAD")])
+        file_path = request["path"].split("?")[0] # the query string does not name a different file
+        if file_path == self.metrics_path:
+            body = metrics.render().encode()
+            header = self.responseHeader("200 OK", [("Content-Type", self.metrics_content_type), ("Content-Length", len(body))], keepAlive)
+            return [header if request["method"] == "HEAD" else header + body, None]
+        url_path = self.normalizePath(file_path)
+        if url_path is None:
+            return self.errorResponse("400 Bad Request", keepAlive)
+
+        # 2. Find the file, in the document root index when there is one, otherwise with os.stat. A directory
+        # path is answered by its index file and redirected first if it lacks its final slash.
+        disk_start = time()
+        indexed = self.index.lookup(url_path) if self.index is not None else None
+        if indexed is not None:
+            metrics.increment("web_index_hits_total")
+            local_path, file_stat, headers = indexed["path"], indexed["stat"], indexed["headers"]
+        else:
+            try:
+                local_path, file_stat = self.statPath(url_path)
+            except IsADirectoryError:
+                return self.errorResponse("301 Moved Permanently", keepAlive, [("Location", url_path + "/")])
+            except (FileNotFoundError, NotADirectoryError):
+                return self.errorResponse("404 Not Found", keepAlive)
+            except PermissionError:
+                return self.errorResponse("403 Forbidden", keepAlive)
+            except OSError as error:
+                log.write("error", "Cannot look up %s: %s", url_path, error)
+                return self.errorResponse("500 Internal Server Error", keepAlive)
+            headers = None
+
+        # 3. A file still matching its cached entry is served from memory without touching the disk
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.lookup(local_path, file_stat)
+        if entry is not None:
+            metrics.increment("web_cache_hits_total")
+            headers, body = entry["headers"], entry["body"]
+        else:
+            if self.cache is not None:
+                metrics.increment("web_cache_misses_total")
+            # 4. Otherwise open it in binary mode, the headers describe the opened file so they match what is sent
+            # An index entry can be out of date, the file may have gone or been replaced by a directory
+            try:
+                file = open(local_path, "rb")
+            except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                return self.errorResponse("404 Not Found", keepAlive)
+            except PermissionError:
+                return self.errorResponse("403 Forbidden", keepAlive)
+            except OSError as error:
+                log.write("error", "Cannot open %s: %s", local_path, error)
+                return self.errorResponse("500 Internal Server Error", keepAlive)
+            opened_stat = os.fstat(file.fileno())
+            if headers is None or (opened_stat.st_mtime_ns, opened_stat.st_size) != (file_stat.st_mtime_ns, file_stat.st_size):
+                headers = self.fileHeaders(local_path, opened_stat) # not indexed, or changed since the last scan
+            file_stat, body = opened_stat, file
+
+            # 5. Small files are read once and cached, larger ones are streamed with sendfile
+            if self.cache is not None and file_stat.st_size <= self.cache.max_entry_size:
+                body = file.read()
+                file.close()
+                self.cache.store(local_path, {"mtime": file_stat.st_mtime_ns, "size": len(body),
+                                                  "headers": headers, "body": body})
+            metrics.observe("web_disk_read_seconds", time() - disk_start) # sendfile reads the rest while sending
+
+        # 6. A client whose copy is still current only gets the validators back
+        if self.isNotModified(request, file_stat, headers[2][1]):
+            if not isinstance(body, bytes):
+                body.close()
+            return [self.responseHeader("304 Not Modified", headers[2:], keepAlive), None]
+
+        # 7. A single byte range of a GET is answered with 206 Partial Content, the range of an uncached file
+        # is a slice of a read-only memory map so resumed and parallel downloads never read it from the start
+        size = file_stat.st_size
+        byte_range = self.requestedRange(request, size, headers[2][1], headers[3][1]) if request["method"] == "GET" else None
+        if byte_range is not None:
+            first, last = byte_range
+            if first >= size:
+                if not isinstance(body, bytes):
+                    body.close()
+                return self.errorResponse("416 Range Not Satisfiable", keepAlive, [("Content-Range", "bytes */%d" % (size))])
+            header = self.responseHeader("206 Partial Content", [headers[0], ("Content-Length", last - first + 1),
+                                         ("Content-Range", "bytes %d-%d/%d" % (first, last, size))] + headers[2:], keepAlive)
+            if isinstance(body, bytes):
+                return [header + body[first:last + 1], None]
+            mapping = mmap.mmap(body.fileno(), 0, access=mmap.ACCESS_READ)
+            body.close()
+            return [header, memoryview(mapping)[first:last + 1]]
+
+        header = self.responseHeader("200 OK", headers, keepAlive)
+        if request["method"] == "HEAD":
+            if not isinstance(body, bytes):
+                body.close()
+            return [header, None]
+        if isinstance(body, bytes):
+            return [header + body, None]
+        return [header, body]
+
+    async def serveConnection(self, stream):
+        # Serves every request arriving on the connection in order, pipelined requests are already in the
+        # buffer so they are answered without waiting for another read. Shared by the threads and sequential
+        # modes, over a SocketStream, and the async runtime, over an AsyncStream.
+        progress = {}
+        served = 0
+        file = None
+        try:
+            address = stream.peer() if log.enabled("info") else "-"
+            while True:
+                # 1. Receive the next request message from the client on connection socket
+                try:
+                    request = self.takeRequest(stream.pending, progress)
+                    while request is None:
+                        if not await stream.fill():
+                            return
+                        request = self.takeRequest(stream.pending, progress)
+                except ValueError as error:
+                    header = self.errorResponse(self.parseErrorStatus(error))[0]
+                    await stream.write(header)
+                    self.recordResponse(address, None, header, len(header), time())
+                    return
+                started = time()
+                served += 1
+                keep_alive = self.wantsKeepAlive(request) and served < self.max_requests
+
+                # 2. Send the correct HTTP response header
+                header, file = self.buildResponse(request, keep_alive)
+                await stream.write(header)
+                sent = len(header)
 
-        # 4. When a connection is accepted, call handleRequest function, passing new connection socket (see https://docs.python.org/3/library/socket.html#socket.socket.accept)
+                # 3. Send the content of the file, the kernel copies it with sendfile. A range is sent
+                # straight from its memory map.
+                if isinstance(file, memoryview):
+                    await stream.write(file)
+                    sent += len(file)
+                elif file is not None:
+                    sent += await stream.sendFile(file)
+                if file is not None:
+                    self.closeBody(file)
+                    file = None
+                self.recordResponse(address, request, header, sent, started)
+
+                if not keep_alive:
+                    return
+        except socket.timeout:
+            pass # idle persistent connection
+        except OSError as error:
+            log.write("warning", "Connection error: %s", error)
+        finally:
+            if file is not None:
+                self.closeBody(file)
+            stream.close()
+
+    def handleRequest(self, tcpSocket):
+        self.runToCompletion(self.serveConnection(SocketStream(tcpSocket, self.keep_alive_timeout)))
+
+    def recordResponse(self, address, request, header, sent, started):
+        # Metrics and access log line for a response that has been sent, request is None when it could not be parsed
+        status = int(header[9:12])
+        metrics.increment('web_responses_total{status="%d"}' % (status))
+        metrics.increment("web_bytes_sent_total", sent)
+        metrics.observe("web_request_seconds", time() - started)
+        if log.enabled("info"):
+            request_line = "%s %s %s" % (request["method"], request["path"], request["version"]) if request is not None else "-"
+            log.write("info", '%s "%s" %d %d %.3fms', address, request_line, status, sent, 1000 * (time() - started))
+
+    def serveSequential(self, serverSocket):
+        # When a connection is accepted, call handleRequest function, passing new connection socket (see https://docs.python.org/3/library/socket.html#socket.socket.accept)
+        # A persistent connection would stop every other client from being served, so each one gets a single request
+        self.max_requests = 1
         while True:
-            connectionSocket, address = serverSocket.accept()
+            try:
+                connectionSocket, address = serverSocket.accept()
+            except OSError:
+                if self.stopping:
+                    return
+                raise
+            connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            metrics.increment("web_connections_accepted_total")
             self.handleRequest(connectionSocket)
 
-        # 5. Close server socket
-        serverSocket.close()
+    def serveSelectors(self, serverSocket):
+        # Single threaded event loop, every connection is non-blocking and keeps its own
+        # buffered requests and pending response, idle connections are closed once a second
+        selector = selectors.DefaultSelector()
+        serverSocket.setblocking(False)
+        selector.register(serverSocket, selectors.EVENT_READ, None)
+        next_sweep = time() + 1
+
+        while True:
+            for key, events in selector.select(timeout=1):
+                if key.data is None:
+                    self.acceptConnection(selector, key.fileobj)
+                elif events & selectors.EVENT_READ:
+                    self.readConnection(selector, key)
+                elif events & selectors.EVENT_WRITE:
+                    self.writeConnection(selector, key)
+
+            if time() >= next_sweep:
+                self.closeIdleConnections(selector)
+                next_sweep = time() + 1
+
+            # Stopping, the listener is closed and the loop ends once the responses in progress are sent
+            if self.stopping:
+                if serverSocket in [key.fileobj for key in selector.get_map().values()]:
+                    selector.unregister(serverSocket)
+                    stop_deadline = time() + self.shutdown_timeout
+                busy = [key for key in selector.get_map().values() if key.data["response"] or key.data["file"] is not None]
+                if not busy or time() >= stop_deadline:
+                    for key in list(selector.get_map().values()):
+                        self.closeConnection(selector, key.fileobj, key.data)
+                    return
+
+    def acceptConnection(self, selector, serverSocket):
+        try:
+            connectionSocket, address = serverSocket.accept()
+        except OSError: # another process took the connection, or the listener was closed to stop
+            return
+        connectionSocket.setblocking(False)
+        connectionSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        metrics.increment("web_connections_accepted_total")
+        selector.register(connectionSocket, selectors.EVENT_READ,
+                            {"request": bytearray(), "progress": {}, "response": b"", "file": None, "offset": 0,
+                             "served": 0, "keep_alive": False, "last_active": time(),
+                             "address": address[0], "current": None, "sent": 0})
+
+    def closeConnection(self, selector, connectionSocket, state):
+        selector.unregister(connectionSocket)
+        connectionSocket.close()
+        if state["file"] is not None:
+            self.closeBody(state["file"])
+            state["file"] = None
+
+    def closeIdleConnections(self, selector):
+        deadline = time() - self.keep_alive_timeout
+        for key in list(selector.get_map().values()):
+            if key.data is not None and key.data["last_active"] < deadline:
+                self.closeConnection(selector, key.fileobj, key.data)
+
+    def startNextResponse(self, selector, connectionSocket, state):
+        # Builds the response to the next buffered request, returns False when no complete request is buffered yet
+        try:
+            request = self.takeRequest(state["request"], state["progress"])
+        except ValueError as error:
+            state["response"], state["file"] = self.errorResponse(self.parseErrorStatus(error))
+            state["keep_alive"] = False
+            state["current"], state["sent"] = [None, state["response"][:12], time()], 0
+            selector.modify(connectionSocket, selectors.EVENT_WRITE, state)
+            return True
+        if request is None:
+            return False
+
+        state["served"] += 1
+        state["keep_alive"] = self.wantsKeepAlive(request) and state["served"] < self.max_requests
+        started = time()
+        state["response"], state["file"] = self.buildResponse(request, state["keep_alive"])
+        state["offset"] = 0
+        state["current"], state["sent"] = [request, state["response"][:12], started], 0 # status line kept for the log
+        selector.modify(connectionSocket, selectors.EVENT_WRITE, state)
+        return True
+
+    def readConnection(self, selector, key):
+        connectionSocket, state = key.fileobj, key.data
+        try:
+            data = connectionSocket.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.closeConnection(selector, connectionSocket, state)
+            return
+
+        state["request"] += data
+        state["last_active"] = time()
+        self.startNextResponse(selector, connectionSocket, state)
+
+    def sendFileChunk(self, connectionSocket, state):
+        # Non-blocking sockets cannot use socket.sendfile, so os.sendfile is called directly with an
+        # explicit offset, if the platform or file does not support it a single chunk is read instead.
+        # A memory mapped range is sent a chunk of the mapping at a time.
+        file = state["file"]
+        if isinstance(file, memoryview):
+            sent = connectionSocket.send(file[state["offset"]:state["offset"] + self.chunk_size])
+            state["offset"] += sent
+            state["sent"] += sent
+            return sent
+        try:
+            sent = os.sendfile(connectionSocket.fileno(), file.fileno(), state["offset"], self.chunk_size)
+            state["offset"] += sent
+            state["sent"] += sent
+            return sent
+        except BlockingIOError:
+            raise
+        except (AttributeError, OSError):
+            file.seek(state["offset"])
+            state["response"] = file.read(self.chunk_size)
+            state["offset"] += len(state["response"])
+            return len(state["response"])
+
+    def writeConnection(self, selector, key):
+        connectionSocket, state = key.fileobj, key.data
+        state["last_active"] = time()
+        try:
+            # 1. Flush the header (or a chunk read by the fallback path) first
+            if state["response"]:
+                sent = connectionSocket.send(state["response"])
+                state["response"] = state["response"][sent:]
+                state["sent"] += sent
+                return
+
+            # 2. Then let the kernel copy the file body, a zero byte transfer means end of file
+            if state["file"] is not None and self.sendFileChunk(connectionSocket, state) > 0:
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            state["keep_alive"] = False
+
+        # 3. The response is complete, either answer the next pipelined request or wait for one
+        request, header, started = state["current"]
+        self.recordResponse(state["address"], request, header, state["sent"], started)
+        if state["file"] is not None:
+            self.closeBody(state["file"])
+            state["file"] = None
+        if not state["keep_alive"]:
+            self.closeConnection(selector, connectionSocket, state)
+        elif not self.startNextResponse(selector, connectionSocket, state):
+            selector.modify(connectionSocket, selectors.EVENT_READ, state)
+
+    async def handleRequestAsync(self, reader, writer):
+        metrics.increment("web_connections_accepted_total")
+        await self.serveConnection(AsyncStream(reader, writer, self.keep_alive_timeout))
+
+    async def serveAsync(self, port, backlog):
+        # The web server as a service of the async runtime, every connection is a coroutine on the shared loop
+        if self.index is not None:
+            self.index.start()
+        server = await asyncio.start_server(self.handleRequestAsync, "localhost", port, backlog=backlog)
+        async with server:
+            await server.serve_forever()
+
+    def __init__(self, args, start=True):
+        if start:
+            print('Web Server starting on port: %i...' % (args.port))
+            log.configure(args.log_level, args.access_log)
+        self.keep_alive_timeout = args.keep_alive_timeout
+        self.max_requests = args.max_requests
+        self.root = args.root
+        if args.cache_size > 0:
+            self.cache = HotFileCache(int(args.cache_size * 1024 * 1024) // args.workers) # the budget is shared by all workers
+        if args.index:
+            self.index = DocumentIndex(self.root, self.index_files, self.fileHeaders, args.index_refresh) # shared by the workers until they refresh it
+        if not start:
+            return
+        if args.workers > 1:
+            Supervisor(self, args).run()
+            return
+        serverSocket = self.createServerSocket(args.port, args.backlog)
+        try:
+            self.serveListener(serverSocket, args)
+        finally:
+            # 5. Close server socket
+            serverSocket.close()
+
+    def serveListener(self, serverSocket, args):
+        # 4. Serve connections using the selected concurrency mode
+        if self.index is not None:
+            self.index.start()
+        if args.concurrency == 'threads':
+            self.serveThreadPool(serverSocket, args.threads)
+        elif args.concurrency == 'selectors':
+            self.serveSelectors(serverSocket)
+        else:
+            self.serveSequential(serverSocket)
+
+
+class ProxyCache:
+    # HTTP cache for the proxy, entries are keyed by method and absolute URL and stored binary safe on disk
+    # in a sharded layout (ab/cd/abcd...) next to a small JSON metadata file. An in-memory index tracks every
+    # entry in LRU order and small bodies are also kept in memory, both tiers are bounded by a byte budget.
+    cacheable_statuses = (200, 203, 301, 404, 410)
+    heuristic_limit = 86400 # longest heuristic freshness lifetime given to responses without explicit expiry
+
+    def __init__(self, directory, maxDiskBytes, maxMemoryBytes):
+        self.directory = directory
+        self.max_disk_bytes = maxDiskBytes
+        self.max_memory_bytes = maxMemoryBytes
+        self.max_memory_entry = maxMemoryBytes // 16
+        self.index = collections.OrderedDict() # key hash -> metadata, least recently used first
+        self.memory = collections.OrderedDict() # key hash -> body bytes
+        self.disk_bytes = 0
+        self.memory_bytes = 0
+        self.statistics = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+        self.lock = threading.Lock()
+        self.loadIndex()
+
+    def keyHash(self, key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def entryPath(self, keyHash):
+        return os.path.join(self.directory, keyHash[:2], keyHash[2:4], keyHash)
+
+    def loadIndex(self):
+        # Rebuilds the in-memory index from the metadata files left by a previous run, oldest entries first
+        entries = []
+        for directory, subdirectories, files in os.walk(self.directory):
+            subdirectories[:] = [name for name in subdirectories if len(name) == 2] # shards only, not worker subdirectories
+            for name in files:
+                path = os.path.join(directory, name)
+                if name.endswith(".part"):
+                    os.remove(path) # interrupted write
+                elif name.endswith(".meta"):
+                    try:
+                        with open(path) as metaFile:
+                            meta = json.load(metaFile)
+                        if os.path.getsize(path[:-5]) == meta["size"]:
+                            entries.append(meta)
+                            continue
+                    except (OSError, ValueError, KeyError):
+                        pass
+                    self.removeFiles(name[:-5])
+
+        for meta in sorted(entries, key=lambda meta: meta["stored"]):
+            self.index[meta["hash"]] = meta
+            self.disk_bytes += meta["size"]
+        self.evict()
+
+    def cacheControl(self, headers):
+        directives = {}
+        for directive in headers.get("cache-control", "").lower().split(","):
+            name, separator, value = directive.strip().partition("=")
+            if name:
+                directives[name] = value.strip('"')
+        return directives
+
+    def freshnessLifetime(self, headers, now):
+        # Explicit freshness from Cache-Control or Expires, otherwise 10% of the time since Last-Modified (RFC 9111 section 4.2)
+        directives = self.cacheControl(headers)
+        for name in ("s-maxage", "max-age"):
+            if directives.get(name, "").isdigit():
+                return int(directives[name])
+        try:
+            date = email.utils.parsedate_to_datetime(headers["date"]).timestamp() if "date" in headers else now
+            if "expires" in headers:
+                return max(0, email.utils.parsedate_to_datetime(headers["expires"]).timestamp() - date)
+            if "last-modified" in headers:
+                age = date - email.utils.parsedate_to_datetime(headers["last-modified"]).timestamp()
+                return min(max(0, age / 10), self.heuristic_limit)
+        except (TypeError, ValueError):
+            pass
+        return 0
+
+    def isStorable(self, request, status, headers):
+        request_directives = self.cacheControl(request["headers"])
+        response_directives = self.cacheControl(headers)
+        if request["method"] != "GET" or status not in self.cacheable_statuses:
+            return False
+        if "no-store" in request_directives or "no-store" in response_directives or "private" in response_directives:
+            return False
+        if "authorization" in request["headers"] and "public" not in response_directives:
+            return False
+        return headers.get("vary", "").strip() != "*"
+
+    def lookup(self, key, request):
+        # Returns [metadata, body] for a matching entry, the body is either bytes or an open file that the caller closes
+        key_hash = self.keyHash(key)
+        with self.lock:
+            meta = self.index.get(key_hash)
+            if meta is None or meta["key"] != key:
+                return None
+            for name, value in meta["vary"].items():
+                if request["headers"].get(name) != value:
+                    return None
+            self.index.move_to_end(key_hash)
+
+            body = self.memory.get(key_hash)
+            if body is not None:
+                self.memory.move_to_end(key_hash)
+                return [dict(meta), body]
+            try:
+                body = open(self.entryPath(key_hash), "rb")
+            except FileNotFoundError:
+                self.remove(key_hash)
+                return None
+
+            # Entries small enough for the memory tier are promoted the first time they are read from disk
+            if meta["size"] <= self.max_memory_entry:
+                data = body.read()
+                body.close()
+                self.storeInMemory(key_hash, data)
+                return [dict(meta), data]
+            return [dict(meta), body]
+
+    def isFresh(self, meta, request):
+        if "no-cache" in self.cacheControl(request["headers"]) or meta["no_cache"]:
+            return False
+        return time() < meta["expires"]
+
+    def validators(self, meta):
+        # Conditional headers used to revalidate a stale entry with the origin server
+        headers = []
+        if meta["etag"]:
+            headers.append(("If-None-Match", meta["etag"]))
+        if meta["last_modified"]:
+            headers.append(("If-Modified-Since", meta["last_modified"]))
+        return headers
+
+    def openWriter(self, key, request, status, headers, header):
+        # Starts storing a response, the body is streamed in with write and only becomes visible on commit
+        now = time()
+        lifetime = self.freshnessLifetime(headers, now)
+        vary = {}
+        for name in headers.get("vary", "").lower().split(","):
+            if name.strip():
+                vary[name.strip()] = request["headers"].get(name.strip())
+
+        key_hash = self.keyHash(key)
+        meta = {"key": key, "hash": key_hash, "size": 0, "stored": now, "expires": now + lifetime,
+                "no_cache": "no-cache" in self.cacheControl(headers), "etag": headers.get("etag"),
+                "last_modified": headers.get("last-modified"), "vary": vary, "header": header.decode("iso-8859-1")}
+        if lifetime <= 0 and not meta["etag"] and not meta["last_modified"]:
+            return None # it could never be served without going back to the origin anyway
+
+        path = self.entryPath(key_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = "%s.%d.%d.part" % (path, os.getpid(), threading.get_ident())
+        return {"meta": meta, "file": open(part_path, "wb"), "memory": bytearray()}
+
+    def write(self, writer, data):
+        writer["file"].write(data)
+        writer["meta"]["size"] += len(data)
+        if writer["memory"] is not None:
+            writer["memory"] += data
+            if len(writer["memory"]) > self.max_memory_entry:
+                writer["memory"] = None
+
+    def commit(self, writer):
+        meta = writer["meta"]
+        writer["file"].close()
+        path = self.entryPath(meta["hash"])
+        with self.lock:
+            if meta["hash"] in self.index:
+                self.remove(meta["hash"])
+            os.replace(writer["file"].name, path)
+            with open(path + ".meta", "w") as metaFile:
+                json.dump(meta, metaFile)
+            self.index[meta["hash"]] = meta
+            self.disk_bytes += meta["size"]
+            if writer["memory"] is not None:
+                self.storeInMemory(meta["hash"], bytes(writer["memory"]))
+            self.statistics["stored"] += 1
+            metrics.increment("proxy_cache_stored_total")
+            self.evict()
+
+    def abort(self, writer):
+        writer["file"].close()
+        os.remove(writer["file"].name)
+
+    def refresh(self, meta, headers):
+        # A 304 from the origin makes the stored response fresh again
+        now = time()
+        with self.lock:
+            stored = self.index.get(meta["hash"])
+            if stored is None:
+                return
+            stored["stored"] = now
+            stored["expires"] = now + self.freshnessLifetime(headers, now)
+            with open(self.entryPath(stored["hash"]) + ".meta", "w") as metaFile:
+                json.dump(stored, metaFile)
+
+    def storeInMemory(self, keyHash, body):
+        if keyHash in self.memory:
+            self.memory_bytes -= len(self.memory.pop(keyHash))
+        self.memory[keyHash] = body
+        self.memory_bytes += len(body)
+        while self.memory_bytes > self.max_memory_bytes:
+            self.memory_bytes -= len(self.memory.popitem(last=False)[1])
+
+    def removeFiles(self, keyHash):
+        for path in (self.entryPath(keyHash), self.entryPath(keyHash) + ".meta"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def remove(self, keyHash):
+        meta = self.index.pop(keyHash)
+        self.disk_bytes -= meta["size"]
+        if keyHash in self.memory:
+            self.memory_bytes -= len(self.memory.pop(keyHash))
+        self.removeFiles(keyHash)
+
+    def evict(self):
+        # Least recently used entries are dropped until the disk budget is met again
+        while self.disk_bytes > self.max_disk_bytes and self.index:
+            self.remove(next(iter(self.index)))
+            self.statistics["evicted"] += 1
+            metrics.increment("proxy_cache_evicted_total")
+
+    def record(self, event):
+        metrics.increment("proxy_cache_%s_total" % (event))
+        with self.lock:
+            self.statistics[event] += 1
+
+    def report(self):
+        lookups = self.statistics["hits"] + self.statistics["revalidated"] + self.statistics["misses"]
+        hit_ratio = 100.0 * (self.statistics["hits"] + self.statistics["revalidated"]) / lookups if lookups else 0.0
+        return ("Cache statistics: hits=%d revalidated=%d misses=%d stored=%d evicted=%d hit ratio=%.2f%% entries=%d disk=%d bytes memory=%d bytes"
+                % (self.statistics["hits"], self.statistics["revalidated"], self.statistics["misses"], self.statistics["stored"],
+                   self.statistics["evicted"], hit_ratio, len(self.index), self.disk_bytes, self.memory_bytes))
+
+
+class ResolverCache:
+    # Caches hostname lookups for a fixed time to live, getaddrinfo does not report the record TTL. Expired
+    # entries are dropped when they are looked up and the least recently used ones once there are max_entries.
+    max_entries = 1024
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # (hostname, port) -> [addresses, expiry time], least recently used first
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time():
+                self.entries.move_to_end(key)
+                metrics.increment("proxy_dns_cache_hits_total")
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+        metrics.increment("proxy_dns_cache_misses_total")
+        return None
+
+    def store(self, key, infos):
+        addresses = [info[4] for info in infos]
+        with self.lock:
+            self.entries[key] = [addresses, time() + self.ttl]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return addresses
+
+    def resolve(self, hostname, port):
+        # The lookup itself runs outside the lock so one slow name does not hold up the others
+        key = (hostname.lower(), port)
+        addresses = self.lookup(key)
+        if addresses is not None:
+            return addresses
+        return self.store(key, socket.getaddrinfo(hostname, port, socket.AF_INET, socket.SOCK_STREAM))
+
+    async def resolveAsync(self, hostname, port):
+        # resolve for the event loop, a name that is not cached is looked up on the loop's resolver threads
+        key = (hostname.lower(), port)
+        addresses = self.lookup(key)
+        if addresses is not None:
+            return addresses
+        infos = await asyncio.get_running_loop().getaddrinfo(hostname, port, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        return self.store(key, infos)
+
+
+class StaleConnectionError(ConnectionError):
+    # Raised when a pooled connection turns out to have been closed by the origin before answering
+    pass
+
+
+class BadResponseError(ConnectionError):
+    # Raised when the origin sends a response header or body framing that cannot be parsed, the client gets a
+    # 502 when nothing has been sent to it yet and is disconnected otherwise, like when the origin goes away
+    pass
+
+
+class UpstreamPool:
+    # Keep-alive connections to origin servers, idle ones are kept per (hostname, port) for up to
+    # idleTimeout seconds and no origin ever has more than maxPerHost connections open at once.
+    # connect returns a SocketStream. acquire and release are coroutines so the proxy's shared request path
+    # can await them, here they never suspend and block the calling worker thread instead.
+    def __init__(self, connect, maxPerHost, idleTimeout, timeout):
+        self.connect = connect
+        self.max_per_host = maxPerHost
+        self.idle_timeout = idleTimeout
+        self.timeout = timeout
+        self.idle = {} # origin -> [[stream, time it was released], ...], most recently used last
+        self.open_count = {} # origin -> idle plus in use connections
+        self.condition = threading.Condition()
+
+    def takeLocked(self, origin, fresh):
+        # Returns a usable idle connection to origin or None, reserving a new one in that case when there is
+        # room. Raises LookupError when origin already has maxPerHost connections open.
+        idle = self.idle.get(origin, [])
+        while idle:
+            stream, released = idle.pop()
+            if not idle:
+                del self.idle[origin]
+            if not fresh and time() - released < self.idle_timeout and stream.isUsable():
+                return stream
+            self.closeLocked(origin, stream)
+        if self.open_count.get(origin, 0) >= self.max_per_host:
+            raise LookupError(origin)
+        self.open_count[origin] = self.open_count.get(origin, 0) + 1
+        return None
+
+    def releaseLocked(self, origin, stream, reusable):
+        # A connection with unread bytes goes back to nobody, the next request would read them as its response
+        if reusable and stream.isUsable():
+            self.idle.setdefault(origin, []).append([stream, time()])
+        else:
+            self.closeLocked(origin, stream)
+
+    def closeLocked(self, origin, stream):
+        stream.close()
+        self.uncountLocked(origin)
+
+    def uncountLocked(self, origin):
+        # An origin without open connections is forgotten, so origins visited once do not stay in the pool
+        self.open_count[origin] -= 1
+        if self.open_count[origin] == 0:
+            del self.open_count[origin]
+
+    def closeIdleLocked(self):
+        # Closes connections that have been idle for longer than the idle timeout
+        for origin, idle in list(self.idle.items()):
+            for entry in [entry for entry in idle if time() - entry[1] >= self.idle_timeout]:
+                idle.remove(entry)
+                self.closeLocked(origin, entry[0])
+            if not idle:
+                del self.idle[origin]
+
+    async def acquire(self, hostname, port, fresh=False):
+        # Returns [stream, reused], reused connections may still turn out to be stale when written to
+        origin = (hostname.lower(), port)
+        deadline = time() + self.timeout
+        with self.condition:
+            while True:
+                try:
+                    stream = self.takeLocked(origin, fresh)
+                    if stream is not None:
+                        return [stream, True]
+                    break
+                except LookupError:
+                    if not self.condition.wait(deadline - time()) and time() >= deadline:
+                        raise TimeoutError("too many connections to %s:%d" % origin)
+
+        try:
+            return [await self.open(hostname, port), False]
+        except BaseException:
+            with self.condition:
+                self.uncountLocked(origin)
+                self.condition.notify()
+            raise
+
+    async def open(self, hostname, port):
+        # A new connection that is not counted by the pool, for CONNECT tunnels
+        return self.connect(hostname, port)
+
+    async def release(self, hostname, port, stream, reusable):
+        with self.condition:
+            self.releaseLocked((hostname.lower(), port), stream, reusable)
+            self.condition.notify()
+
+    def closeIdle(self):
+        with self.condition:
+            self.closeIdleLocked()
+            self.condition.notify_all()
+
+
+class AsyncUpstreamPool(UpstreamPool):
+    # UpstreamPool for the event loop, connect is a coroutine returning an AsyncStream and waiting for a
+    # connection suspends the request instead of blocking the loop's thread
+    def __init__(self, connect, maxPerHost, idleTimeout, timeout):
+        super().__init__(connect, maxPerHost, idleTimeout, timeout)
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, hostname, port, fresh=False):
+        origin = (hostname.lower(), port)
+        deadline = time() + self.timeout
+        async with self.condition:
+            while True:
+                try:
+                    stream = self.takeLocked(origin, fresh)
+                    if stream is not None:
+                        return [stream, True]
+                    break
+                except LookupError:
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), max(0, deadline - time()))
+                    except asyncio.TimeoutError:
+                        raise TimeoutError("too many connections to %s:%d" % origin)
+
+        try:
+            return [await self.open(hostname, port), False]
+        except BaseException:
+            async with self.condition:
+                self.uncountLocked(origin)
+                self.condition.notify()
+            raise
+
+    async def open(self, hostname, port):
+        return await self.connect(hostname, port)
+
+    async def release(self, hostname, port, stream, reusable):
+        async with self.condition:
+            self.releaseLocked((hostname.lower(), port), stream, reusable)
+            self.condition.notify()
+
+    async def closeIdlePeriodically(self):
+        # closeIdle every half idle timeout, until cancelled
+        while True:
+            await asyncio.sleep(max(1, self.idle_timeout / 2))
+            async with self.condition:
+                self.closeIdleLocked()
+                self.condition.notify_all()
 
 
 class Proxy(NetworkApplication):
     # Localhost is the default name of the computer you are working on. The term is a pseudo name for 127.0. 0.1, 
     # the IP address of the local computer. This IP address allows the machine to connect to and communicate with itself
-    max_data_to_receive = 5000
+    metric_prefix = "proxy"
+    chunk_size = 65536 # bytes relayed per recv when streaming a response or tunnel
+    timeout = 10 # seconds to wait on the origin server before giving up
+    hop_by_hop_headers = ("connection", "proxy-connection", "keep-alive", "te", "trailer", "upgrade", "expect")
+    cache = None
+    cache_report_interval = 100 # requests between two printed cache statistics lines, 0 disables them
+    requests_served = 0
 
-    def createProxySocket(self):
-        proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        proxy_socket.bind(("localhost", args.port))
-        proxy_socket.listen()
+    def splitAuthority(self, authority, defaultPort):
+        hostname, separator, port = authority.rpartition(":")
+        if not separator or not port.isdigit():
+            return [authority, defaultPort]
+        return [hostname, int(port)]
 
-        return proxy_socket
+    async def readClientRequest(self, client):
+        # 1. Read until the request header has arrived, None when the client goes away. The body is left in the
+        # client stream and relayed to the origin by sendRequestToServer.
+        progress = {}
+        client_request = self.takeRequest(client.pending, progress, withBody=False)
+        while client_request is None:
+            if not await client.fill():
+                return None
+            client_request = self.takeRequest(client.pending, progress, withBody=False)
 
-    def getRequestInfo(self, clientSocket):
-        client_request = clientSocket.recv(self.max_data_to_receive).decode()        
-        hostname = client_request.split()[4].replace("www.", "")
-        print("Client Request: ", client_request)
-        return [hostname, client_request]
+        # 2. Work out the origin server
+        return self.requestTarget(client_request) + [client_request]
 
-    def createServerScoket(self, hostname):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        print("Hostname is = ", hostname)
-        server_socket.connect((hostname, 80))  # http uses port 80 that is why we are using it here
+    def requestTarget(self, clientRequest):
+        # Returns [hostname, port, path], CONNECT names the origin directly, otherwise it comes from the
+        # absolute URL the browser sends to a proxy, or from the Host header for an origin-form path
+        url = clientRequest["path"]
+        if clientRequest["method"] == "CONNECT":
+            hostname, port = self.splitAuthority(url, 443)
+            path = url
+        else:
+            if url.lower().startswith("http://"):
+                authority, separator, path = url[7:].partition("/")
+                path = "/" + path
+            else:
+                authority, path = clientRequest["headers"].get("host", ""), url
+            hostname, port = self.splitAuthority(authority, 80)
+        return [hostname, port, path]
 
-        return server_socket
-    
-    def cacheServerResponse(self, serverResponse, hostname): # read about the cache also 
-        fileResponse = open(hostname, "w", encoding="utf-8")
-        fileResponse.write(serverResponse.decode())
-        fileResponse.close()
-
-    def sendRequestToServer(self, serverSocket, clientRequestInfo):
-        hostname, clientRequest = clientRequestInfo
-        server_response = None
-
-        if (os.path.isfile(hostname)):
-            requestFile = open(hostname, "rb")
-            server_response = requestFile.read()
-            requestFile.close()  
-            print("Cached Before")
+    def createServerScoket(self, hostname, port):
+        # The hostname is resolved through the resolver cache and each of its addresses is tried in turn
+        error = OSError("no addresses found for %s" % (hostname))
+        for address in self.resolver.resolve(hostname, port):  # http uses port 80 unless the url names another one
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.settimeout(self.timeout)
+            try:
+                start = time()
+                server_socket.connect(address)
+                metrics.observe("proxy_upstream_connect_seconds", time() - start)
+                server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return server_socket
+            except OSError as connect_error:
+                server_socket.close()
+                error = connect_error
+        raise error
+
+    def buildServerRequest(self, clientRequest, path, extraHeaders=()):
+        # The request is forwarded in origin form, hop-by-hop headers only apply to the client connection
+        request = "%s %s HTTP/1.1\r\n" % (clientRequest["method"], path)
+        replaced = [name.lower() for name, value in extraHeaders]
+        for name, value in clientRequest["headers"].items():
+            if name not in self.hop_by_hop_headers and name not in replaced:
+                request += "%s: %s\r\n" % ("-".join(part.capitalize() for part in name.split("-")), value)
+        for name, value in extraHeaders:
+            request += "%s: %s\r\n" % (name, value)
+        request += "Connection: keep-alive\r\n\r\n" # the connection goes back to the upstream pool afterwards
+        return request.encode("iso-8859-1")
+
+    async def relayRequestBody(self, client, server, length):
+        # The request body is copied to the origin as it arrives instead of being buffered first
+        while length > 0:
+            data = await client.read(min(length, client.chunk_size))
+            if not data:
+                raise ConnectionError("client closed the connection in the middle of the request body")
+            await server.write(data)
+            length -= len(data)
+
+    def cacheKey(self, hostname, port, path):
+        # HEAD requests are answered from the stored GET response so both share the GET key
+        return "GET http://%s:%d%s" % (hostname.lower(), port, path)
+
+    def clientResponseHeader(self, header, extraHeaders=()):
+        # The origin's hop-by-hop headers describe the upstream connection, the client connection is
+        # closed after every response so it is told so
+        lines = header.decode("iso-8859-1").split("\r\n")
+        client_header = lines[0] + "\r\n"
+        for line in lines[1:]:
+            name = line.partition(":")[0].strip().lower()
+            if line and name not in self.hop_by_hop_headers:
+                client_header += line + "\r\n"
+        for name, value in extraHeaders:
+            client_header += "%s: %s\r\n" % (name, value)
+        return (client_header + "Connection: close\r\n\r\n").encode("iso-8859-1")
+
+    async def sendCachedResponse(self, client, transfer, cached, method):
+        # The stored header gets an Age field, bodies come from memory or are sent straight from disk
+        meta, body = cached
+        age = int(max(0, time() - meta["stored"]))
+        transfer["status"] = int(meta["header"][9:12])
+        await self.sendToClient(client, transfer, self.clientResponseHeader(meta["header"].encode("iso-8859-1"), [("Age", age)]))
+        if method == "HEAD":
+            pass
+        elif isinstance(body, bytes):
+            await self.sendToClient(client, transfer, body)
         else:
-            serverSocket.sendall(clientRequestInfo[1].encode())
-            server_response = serverSocket.recv(self.max_data_to_receive)
-            self.cacheServerResponse(server_response, hostname)
-            print("File not found")
+            transfer["sent"] += await client.sendFile(body)
+
+    async def readResponseHeader(self, server):
+        header = b""
+        while True:
+            line = await server.readline(self.max_header_size + 1)
+            if not line:
+                raise ConnectionError("origin server closed the connection before sending a response")
+            header += line
+            if line in (b"\r\n", b"\n"):
+                return header
+            if len(header) > self.max_header_size:
+                raise ValueError("response header too large")
+
+    async def relayBody(self, server, client, transfer, cacheWriter, length):
+        # Copies exactly length bytes, or everything until the origin closes when length is None
+        while length is None or length > 0:
+            data = await server.read(self.chunk_size if length is None else min(length, self.chunk_size))
+            if not data:
+                if length is None:
+                    return
+                raise ConnectionError("origin server closed the connection in the middle of the body")
+            await self.forwardData(client, transfer, cacheWriter, data)
+            if length is not None:
+                length -= len(data)
+
+    async def relayChunkedBody(self, server, client, transfer, cacheWriter):
+        # Chunked bodies are relayed as they are, chunk sizes are parsed only to find where the body ends
+        while True:
+            size_line = await server.readline(self.max_header_size + 1)
+            if not size_line:
+                raise ConnectionError("origin server closed the connection in the middle of the body")
+            await self.forwardData(client, transfer, cacheWriter, size_line)
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                break
+            await self.relayBody(server, client, transfer, cacheWriter, size + 2) # chunk data followed by CRLF
+
+        # The last chunk is followed by optional trailer lines and an empty line
+        while True:
+            line = await server.readline(self.max_header_size + 1)
+            await self.forwardData(client, transfer, cacheWriter, line)
+            if line in (b"\r\n", b"\n", b""):
+                return
+
+    async def sendToClient(self, client, transfer, data):
+        # Every byte sent to the client goes through here so the access log and metrics can count it
+        await client.write(data)
+        transfer["sent"] += len(data)
+
+    async def forwardData(self, client, transfer, cacheWriter, data):
+        await self.sendToClient(client, transfer, data)
+        if cacheWriter is not None:
+            self.cache.write(cacheWriter, data)
+
+    def isReusable(self, header, headers, framed):
+        # The upstream connection can go back to the pool when the end of the response was known from its
+        # framing and the origin did not ask to close, HTTP/1.0 origins have to ask to keep it open
+        connection = headers.get("connection", "").lower()
+        if not framed or "close" in connection:
+            return False
+        return not header.startswith(b"HTTP/1.0") or "keep-alive" in connection
+
+    async def sendRequestToServer(self, server, client, transfer, clientRequestInfo, cached=None, reused=False):
+        # Streams the origin response to the client while it arrives instead of buffering it,
+        # storable responses are written to the cache at the same time. When a stale cached entry
+        # is given the request is made conditional and a 304 is answered from the cache.
+        # Returns whether the upstream connection can be reused for another request.
+        hostname, port, path, clientRequest = clientRequestInfo
+        validators = self.cache.validators(cached[0]) if cached is not None else []
+        cache_writer = None
+        try:
+            # 1. Send the request and read the status line and headers, a pooled connection the origin
+            # already closed fails here before anything reached the client so the request can be retried
+            try:
+                await server.write(self.buildServerRequest(clientRequest, path, validators))
+                if (clientRequest["length"] and clientRequest["version"] == "HTTP/1.1"
+                        and "100-continue" in clientRequest["headers"].get("expect", "").lower()):
+                    # The proxy meets the expectation itself instead of forwarding it, it is going to take the
+                    # body either way. An interim response does not count as the status, a 502 can still follow.
+                    await self.sendToClient(client, transfer, b"HTTP/1.1 100 Continue\r\n\r\n")
+                await self.relayRequestBody(client, server, clientRequest["length"])
+                header = await self.readResponseHeader(server)
+            except (ConnectionError, socket.timeout) as error:
+                if reused and not isinstance(error, socket.timeout):
+                    raise StaleConnectionError(str(error))
+                raise
+            status, headers = self.parseResponseHeader(header)
+
+            # Interim responses like 100 Continue or 103 Early Hints are dropped, only the final response that
+            # follows them is relayed and cached. Upgrade is never forwarded, so a 101 is an origin error.
+            while 100 <= status < 200:
+                if status == 101:
+                    raise ValueError("unexpected 101 Switching Protocols")
+                header = await self.readResponseHeader(server)
+                status, headers = self.parseResponseHeader(header)
+            length = int(headers["content-length"]) if "content-length" in headers else None # checked before anything is sent
+            if length is not None and length < 0:
+                raise ValueError("negative Content-Length")
+            if status == 304 and cached is not None:
+                self.cache.refresh(cached[0], headers)
+                self.cache.record("revalidated")
+                await self.sendCachedResponse(client, transfer, cached, clientRequest["method"])
+                return self.isReusable(header, headers, True)
+
+            if self.cache is not None and clientRequest["method"] in ("GET", "HEAD"):
+                self.cache.record("misses")
+                if clientRequest["method"] == "GET" and self.cache.isStorable(clientRequest, status, headers):
+                    cache_writer = self.cache.openWriter(self.cacheKey(hostname, port, path), clientRequest, status, headers, header)
+            transfer["status"] = status
+            await self.sendToClient(client, transfer, self.clientResponseHeader(header))
+
+            # 2. Relay the body, its end is given by the framing the origin used
+            framed = True
+            if clientRequest["method"] == "HEAD" or status in (204, 304):
+                pass
+            elif "chunked" in headers.get("transfer-encoding", "").lower():
+                await self.relayChunkedBody(server, client, transfer, cache_writer)
+            elif length is not None:
+                await self.relayBody(server, client, transfer, cache_writer, length)
+            else:
+                await self.relayBody(server, client, transfer, cache_writer, None)
+                framed = False
 
+            # 3. Only a complete response replaces the cached copy
+            if cache_writer is not None:
+                self.cache.commit(cache_writer)
+                cache_writer = None
+            return self.isReusable(header, headers, framed)
+        except ValueError as error:
+            raise BadResponseError("malformed response from %s:%d: %s" % (hostname, port, error))
+        finally:
+            if cache_writer is not None:
+                self.cache.abort(cache_writer)
 
-        serverSocket.close()
-        return server_response
+    async def forwardToServer(self, client, transfer, clientRequestInfo, cached):
+        # Sends the request over a pooled upstream connection, a GET or HEAD that hits a connection the
+        # origin closed while idle is retried once on a new one. Other methods, and requests whose streamed body
+        # could not be sent again, always get a new connection because the origin might have acted on them already.
+        hostname, port, path, clientRequest = clientRequestInfo
+        idempotent = clientRequest["method"] in ("GET", "HEAD") and clientRequest["length"] == 0
+        for attempt in range(2):
+            server, reused = await self.pool.acquire(hostname, port, fresh=not idempotent or attempt > 0)
+            if reused:
+                metrics.increment("proxy_upstream_reused_total")
+            reusable = False
+            try:
+                reusable = await self.sendRequestToServer(server, client, transfer, clientRequestInfo, cached, reused)
+                return
+            except StaleConnectionError:
+                continue
+            finally:
+                await self.pool.release(hostname, port, server, reusable)
+
+    def closeIdleConnections(self):
+        while True:
+            sleep(max(1, self.pool.idle_timeout / 2))
+            self.pool.closeIdle()
+
+    async def serveClient(self, client):
+        # The request path of one client, shared by the threads mode over a SocketStream and the async
+        # runtime over an AsyncStream. transfer is the status and bytes sent of the response.
+        transfer = {"status": 0, "sent": 0}
+        cached = None
+        client_request = None
+        started = time()
+        try:
+            request_info = await self.readClientRequest(client) # request info will contain the server, the path and the full client request
+            if request_info is None:
+                return
+            hostname, port, path, client_request = request_info
+            started = time()
+
+            # 1. GET and HEAD requests are looked up in the cache first, an origin-form request for the
+            # metrics path asks for the proxy's own metrics rather than for a proxied URL
+            own_metrics = client_request["method"] in ("GET", "HEAD") and client_request["path"] == self.metrics_path
+            if self.cache is not None and client_request["method"] in ("GET", "HEAD") and not own_metrics:
+                cached = self.cache.lookup(self.cacheKey(hostname, port, path), client_request)
+
+            if own_metrics:
+                transfer["status"] = 200
+                await self.sendToClient(client, transfer, self.metricsResponse(client_request["method"], "Connection: close"))
+            elif client_request["method"] == "CONNECT":
+                server = await self.pool.open(hostname, port)
+                try:
+                    transfer["status"] = 200
+                    await self.sendToClient(client, transfer, b"HTTP/1.1 200 Connection Established\r\n\r\n")
+                    await client.relay(server, lambda size: transfer.update(sent=transfer["sent"] + size))
+                finally:
+                    server.close()
+            elif cached is not None and self.cache.isFresh(cached[0], client_request):
+                # 2. A fresh entry is a hit and never reaches the origin
+                self.cache.record("hits")
+                await self.sendCachedResponse(client, transfer, cached, client_request["method"])
+            else:
+                # 3. Otherwise go to the origin, revalidating the entry when there is a stale one
+                await self.forwardToServer(client, transfer, request_info, cached)
+        except ValueError:
+            # Only the client's request is parsed outside sendRequestToServer, which reports origin errors as
+            # BadResponseError
+            if transfer["status"] == 0:
+                transfer["status"] = 400
+                await self.sendToClient(client, transfer, b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        except OSError as error:
+            log.write("warning", "Connection error: %s", error)
+            try:
+                if transfer["status"] == 0: # nothing has been sent to the client yet
+                    transfer["status"] = 502
+                    await self.sendToClient(client, transfer, b"HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+        finally:
+            if cached is not None and not isinstance(cached[1], bytes):
+                cached[1].close()
+            if transfer["status"]:
+                try:
+                    address = client.peer() if log.enabled("info") else "-"
+                except OSError:
+                    address = "-"
+                self.recordResponse(address, client_request, transfer["status"], transfer["sent"], started)
+            client.close()
+            if self.cache is not None and self.cache_report_interval > 0:
+                self.reportCacheStatistics()
+
+    def handleRequest(self, clientSocket):
+        self.runToCompletion(self.serveClient(SocketStream(clientSocket)))
+
+    def recordResponse(self, address, clientRequest, status, sent, started):
+        # Metrics and access log line for a response that has been sent, clientRequest is None when it could not be parsed
+        metrics.increment('proxy_responses_total{status="%d"}' % (status))
+        metrics.increment("proxy_bytes_sent_total", sent)
+        metrics.observe("proxy_request_seconds", time() - started)
+        if log.enabled("info"):
+            request_line = "%s %s %s" % (clientRequest["method"], clientRequest["path"], clientRequest["version"]) if clientRequest is not None else "-"
+            log.write("info", '%s "%s" %d %d %.3fms', address, request_line, status, sent, 1000 * (time() - started))
+
+    # The async runtime serves the proxy with the same request path, over AsyncStreams and an AsyncUpstreamPool
+
+    async def openServerConnection(self, hostname, port):
+        error = OSError("no addresses found for %s" % (hostname))
+        for address in await self.resolver.resolveAsync(hostname, port):
+            try:
+                start = time()
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.timeout)
+                metrics.observe("proxy_upstream_connect_seconds", time() - start)
+                return AsyncStream(reader, writer, self.timeout)
+            except (OSError, asyncio.TimeoutError) as connect_error:
+                error = connect_error
+        raise error
+
+    async def handleRequestAsync(self, reader, writer):
+        metrics.increment("proxy_connections_accepted_total")
+        await self.serveClient(AsyncStream(reader, writer, self.timeout))
+
+    async def serveAsync(self, port, backlog):
+        # The proxy as a service of the async runtime, every client is a coroutine on the shared loop
+        self.pool = AsyncUpstreamPool(self.openServerConnection, self.pool_size, self.pool_idle_timeout, self.timeout)
+        idle_closer = asyncio.ensure_future(self.pool.closeIdlePeriodically())
+        server = await asyncio.start_server(self.handleRequestAsync, "localhost", port, backlog=backlog)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            idle_closer.cancel()
+
+    def serveListener(self, serverSocket, args):
+        # Every client is handled by a worker thread so a slow origin only holds up its own client
+        self.pool = UpstreamPool(lambda hostname, port: SocketStream(self.createServerScoket(hostname, port), self.timeout),
+                                 args.pool_size, args.pool_idle_timeout, args.timeout)
+        threading.Thread(target=self.closeIdleConnections, daemon=True).start()
+        self.serveThreadPool(serverSocket, args.threads)
+
+    def reportCacheStatistics(self):
+        with self.report_lock:
+            self.requests_served += 1
+            if self.requests_served % self.cache_report_interval == 0:
+                print(self.cache.report())
+
+    def prepareWorker(self, number, args):
+        # Every worker gets a cache subdirectory and a share of the budgets of its own, as the index and the byte
+        # counts live in the worker, a shared directory would let each worker fill the whole budget and miss the
+        # evictions of the others. A replacement worker takes over the subdirectory of the one it replaces.
+        if args.cache_disk > 0:
+            self.cache = ProxyCache(os.path.join(args.cache_dir, "worker-%d" % (number)),
+                                    args.cache_disk * 1024 * 1024 // args.workers,
+                                    args.cache_memory * 1024 * 1024 // args.workers)
+
+    def __init__(self, args, start=True):
+        if start:
+            print('Web Proxy starting on port: %i...' % (args.port))
+            log.configure(args.log_level, args.access_log)
+        self.timeout = args.timeout
+        self.cache_report_interval = args.cache_report_interval
+        self.report_lock = threading.Lock()
+        self.pool_size = args.pool_size
+        self.pool_idle_timeout = args.pool_idle_timeout
+        if args.cache_disk > 0 and args.workers == 1:
+            self.cache = ProxyCache(args.cache_dir, args.cache_disk * 1024 * 1024, args.cache_memory * 1024 * 1024)
+        self.resolver = ResolverCache(args.dns_ttl)
+        if not start:
+            return
+        if args.workers > 1:
+            Supervisor(self, args).run()
+            return
+        proxy_socket = self.createServerSocket(args.port, args.backlog)
+        try:
+            self.serveListener(proxy_socket, args)
+        finally:
+            proxy_socket.close()
+            if self.cache is not None:
+                print(self.cache.report())
 
-    def sendResponsetoClient(self, clientSocket, serverResponse):
-        print("Sending response to client")
-        clientSocket.sendall(serverResponse)
-        clientSocket.close()
+
+class AsyncRuntime(NetworkApplication):
+    # Runs the web server, the proxy and ping/traceroute monitors as coroutine services on one asyncio event
+    # loop, so a single thread serves HTTP and proxy clients while the monitors keep probing. Raw ICMP sockets
+    # are registered with the loop through loop.add_reader, a service that fails stops the whole runtime.
+    # Each application is built with start=False, which only configures it and leaves running it to the
+    # coroutine (serveAsync or monitorAsync) gathered here.
+
+    async def runServices(self, args):
+        services = []
+        if args.web_port:
+            print('Web Server starting on port: %i...' % (args.web_port))
+            services.append(WebServer(args, start=False).serveAsync(args.web_port, args.backlog))
+        if args.proxy_port:
+            print('Web Proxy starting on port: %i...' % (args.proxy_port))
+            services.append(Proxy(args, start=False).serveAsync(args.proxy_port, args.backlog))
+        if args.metrics_port:
+            services.append(self.serveMetricsAsync(args.metrics_port))
+        if args.ping:
+            ping = ICMPPing(args, start=False)
+            targets = ping.resolveTargets(args.ping)
+            if targets:
+                print('Monitoring %d ping targets every %.1f s...' % (len(targets), args.interval))
+                services.append(ping.monitorAsync(targets, args.timeout, args.report_interval))
+        for number, hostname in enumerate(args.traceroute):
+            print('Monitoring the route to %s every %d s...' % (hostname, args.trace_interval))
+            trace_id = (os.getpid() + 0x8000 + number) & 0xffff # clear of the ping identifiers
+            services.append(Traceroute(args, start=False).monitorAsync(hostname, args.timeout, args.max_hops, args.probes,
+                                                                       args.trace_interval, trace_id))
+
+        if not services:
+            print("Nothing to run, give --web-port, --proxy-port, --ping or --traceroute")
+            return
+        await asyncio.gather(*services)
 
     def __init__(self, args):
-        print('Web Proxy starting on port: %i...' % (args.port))
-        proxy_socket = self.createProxySocket()
+        log.configure(args.log_level, args.access_log) # once for every service
+        try:
+            asyncio.run(self.runServices(args))
+        except KeyboardInterrupt:
+            pass
+
+
+class JobDaemon(NetworkApplication):
+    # Runs ping, traceroute or any other sub-command for clients connecting over a Unix socket, so a script
+    # starting thousands of short probes pays for one interpreter start up and import instead of one each.
+    # Every module is imported before the first job and each job runs in a process forked from the daemon,
+    # so jobs start with the state of a fresh process and cannot disturb each other or the daemon.
+    # A request is a 4 byte length followed by the working directory and the arguments separated by NUL
+    # bytes. The job's standard output and error go to the connection, followed by a NUL byte and its exit
+    # status. A client closing its side of the connection interrupts the job like Ctrl-C would.
+    # Jobs run with the daemon's user, so only that user may connect: the default socket is in a directory
+    # only they can enter, and both ends check who is at the other end of the connection.
+    default_socket = os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "NetworkApplications-%d" % os.getuid(), "daemon.sock")
+
+    @staticmethod
+    def peerUid(connection):
+        # uid of the process at the other end of a Unix socket connection, None where SO_PEERCRED is missing
+        if not hasattr(socket, "SO_PEERCRED"):
+            return None
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        return struct.unpack("3i", credentials)[1]
+
+    def __init__(self, args):
+        self.jobs = set() # pids of the running jobs
+        self.started = 0
+        self.stopping = False
+        listener = self.createJobSocket(args.socket)
+
+        # 1. Everything a job could need is imported once here instead of in every job
+        for value in list(globals().values()):
+            if isinstance(value, LazyModule):
+                value._load()
+
+        # 2. Signals only write to the wakeup pipe, which ends the select below right away
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signalNumber, frame: None)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print("Daemon accepting jobs on %s (pid %d)" % (args.socket, os.getpid()))
+        sys.stdout.flush()
+
+        # 3. Accept and fork until stopped, at most max_jobs jobs run at once
+        try:
+            while not self.stopping:
+                waiting = [wakeup_read] + ([listener] if len(self.jobs) < args.max_jobs else [])
+                readable = select.select(waiting, [], [])[0]
+                if wakeup_read in readable:
+                    while True:
+                        try:
+                            if not os.read(wakeup_read, 512):
+                                break
+                        except BlockingIOError:
+                            break
+                self.reapJobs()
+                if listener in readable and not self.stopping:
+                    try:
+                        connection = listener.accept()[0]
+                    except BlockingIOError:
+                        continue
+                    if self.peerUid(connection) not in (None, os.getuid()):
+                        connection.close()
+                        continue
+                    self.startJob(connection, [listener.fileno(), wakeup_read, wakeup_write])
+        finally:
+            listener.close()
+            os.unlink(args.socket)
+        print("Daemon stopped after starting %d jobs, %d still running" % (self.started, len(self.jobs)))
+
+    def createJobSocket(self, path):
+        # 1. The default directory is created private, and not used when someone else got to create it first
+        # or it is open to others, as they could then replace the socket with their own
+        if path == self.default_socket:
+            directory = os.path.dirname(path)
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            status = os.lstat(directory)
+            if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+                print("Refusing to use %s, it is not a directory only you can access" % (directory))
+                sys.exit(1)
+
+        # 2. A socket file left behind by a daemon that died is replaced, one that is answering or that is
+        # not this user's socket is not
+        if os.path.lexists(path):
+            status = os.lstat(path)
+            if not stat.S_ISSOCK(status.st_mode) or status.st_uid != os.getuid():
+                print("Refusing to replace %s, it is not a socket of yours" % (path))
+                sys.exit(1)
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                print("A daemon is already accepting jobs on %s" % (path))
+                sys.exit(1)
+            except ConnectionRefusedError:
+                os.unlink(path)
+            finally:
+                probe.close()
+        # 3. The socket file is created accessible to this user only, rather than changed after it appeared
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            listener.bind(path)
+        finally:
+            os.umask(umask)
+        listener.listen(128)
+        listener.setblocking(False)
+        return listener
+
+    def stop(self, signalNumber=None, frame=None):
+        self.stopping = True
+
+    def reapJobs(self):
+        while self.jobs:
+            try:
+                pid = os.waitpid(-1, os.WNOHANG)[0]
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.jobs.discard(pid)
+
+    def startJob(self, connection, daemonFds):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.runJob(connection, daemonFds) # never returns
+        connection.close()
+        self.jobs.add(pid)
+        self.started += 1
+
+    def readRequest(self, connection):
+        # [working directory, arguments], None when the client hung up without a request like the check
+        # for a running daemon does
+        data = b""
+        while len(data) < 4 or len(data) < 4 + struct.unpack("!I", data[:4])[0]:
+            chunk = connection.recv(65536)
+            if not chunk:
+                return None
+            data += chunk
+        fields = [os.fsdecode(field) for field in data[4:].split(b"\0")]
+        return fields[0], fields[1:]
+
+    def watchClient(self, connection):
+        # Nothing is sent after the request, so the read only returns once the client has hung up
+        try:
+            connection.recv(1)
+        except OSError:
+            pass
+        os.kill(os.getpid(), signal.SIGINT)
+
+    def runJob(self, connection, daemonFds):
+        # The forked process must never return into the daemon's loop, whatever goes wrong
+        status = 1
+        try:
+            status = self.executeJob(connection, daemonFds)
+        except BaseException:
+            with contextlib.suppress(BaseException):
+                traceback.print_exc()
+        finally:
+            with contextlib.suppress(BaseException):
+                log.flush()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                connection.sendall(b"\0%d\n" % (status))
+            os._exit(status)
+
+    def executeJob(self, connection, daemonFds):
+        # 1. Undo what the daemon set up for itself
+        signal.set_wakeup_fd(-1)
+        for fd in daemonFds:
+            os.close(fd)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        # 2. Read the request with a timeout so a silent client cannot keep the job around
+        connection.settimeout(10)
+        request = self.readRequest(connection)
+        if request is None:
+            return 0
+        directory, argv = request
+        connection.settimeout(None)
+
+        # 3. The job writes to the connection as if it were a terminal
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.close(null_fd)
+        os.dup2(connection.fileno(), 1)
+        os.dup2(connection.fileno(), 2)
+        sys.stdout.reconfigure(line_buffering=True)
+        os.chdir(directory)
+        threading.Thread(target=self.watchClient, args=(connection,), daemon=True).start()
+
+        # 4. Run it like __main__ would
+        try:
+            job_args = setupArgumentParser(argv)
+            job_args.func(job_args)
+        except SystemExit as error:
+            if error.code is None or isinstance(error.code, int):
+                return error.code or 0
+            print(error.code, file=sys.stderr)
+            return 1
+        except KeyboardInterrupt:
+            return 130
+        return 0
+
+
+class JobClient(NetworkApplication):
+    # Thin client of the daemon sub-command. It sends its arguments and working directory, copies the job's
+    # output to standard output and exits with the job's status. When it is the sub-command it is started
+    # before argparse and the other lazily imported modules are loaded.
+    Arguments = collections.namedtuple("Arguments", ["func", "socket", "job"])
+
+    @staticmethod
+    def quickArguments(argv):
+        # The client's own options are read by hand, None leaves anything unusual like --help to argparse
+        if argv[:1] not in (['client'], ['c']):
+            return None
+        argv = argv[1:]
+        socket_path = JobDaemon.default_socket
+        if argv[:1] in (['--socket'], ['-S']) and len(argv) > 1:
+            socket_path, argv = argv[1], argv[2:]
+        if not argv or argv[0].startswith("-"):
+            return None
+        return JobClient.Arguments(JobClient, socket_path, argv)
+
+    def __init__(self, args):
+        if not args.job:
+            print("No job given, for example: client ping 127.0.0.1 --count 1", file=sys.stderr)
+            sys.exit(2)
+        sys.exit(self.runJob(args.socket, args.job, sys.stdout.buffer))
+
+    @staticmethod
+    def runJob(socketPath, argv, output):
+        # Sends one job to the daemon and copies its output to output, returns the job's exit status.
+        # A static method so the startup benchmark can send jobs without being a client itself.
+        # 1. Send the request
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(socketPath)
+        except OSError as error:
+            print("Cannot reach the daemon on %s: %s" % (socketPath, error.strerror), file=sys.stderr)
+            return 1
+        if JobDaemon.peerUid(connection) not in (None, os.getuid()):
+            print("The daemon on %s belongs to another user, not sending it the job" % (socketPath), file=sys.stderr)
+            connection.close()
+            return 1
+        payload = b"\0".join(os.fsencode(field) for field in [os.getcwd()] + list(argv))
+        connection.sendall(struct.pack("!I", len(payload)) + payload)
+
+        # 2. Copy the output, holding back everything from the last NUL byte as it may be the status
+        held = b""
+        interrupted = False
+        with connection:
+            while True:
+                try:
+                    data = connection.recv(65536)
+                except KeyboardInterrupt:
+                    # The first Ctrl-C interrupts the job and waits for its last lines, the second gives up
+                    if interrupted:
+                        return 130
+                    interrupted = True
+                    connection.shutdown(socket.SHUT_WR)
+                    continue
+                if not data:
+                    break
+                held += data
+                position = held.rfind(b"\0")
+                if position == -1:
+                    output.write(held)
+                    held = b""
+                else:
+                    output.write(held[:position])
+                    held = held[position:]
+                output.flush()
 
+        # 3. The status is the end of the stream, a job that died without sending it failed
+        if held[1:-1].isdigit() and held.endswith(b"\n"):
+            return int(held[1:-1])
+        output.write(held)
+        output.flush()
+        print("The job ended without an exit status", file=sys.stderr)
+        return 1
+
+
+class ChecksumBenchmark(NetworkApplication):
+    # Checks checksum against referenceChecksum and times both across payload sizes
+
+    def verify(self, sizes):
+        # Random payloads of every length up to 300 bytes and of each benchmarked size, plus the edge cases
+        # where the sum is zero or a multiple of 0xffff, and every sequence number of a cached echo request
+        samples = [bytes(0), bytes(64), bytes([0xff]) * 64, bytes([0xff, 0xff, 0x00]), bytes([0x01, 0x00, 0xfe, 0xff])]
+        samples += [os.urandom(length) for length in range(301)] + [os.urandom(size) for size in sizes]
+        for sample in samples:
+            if self.checksum(sample) != self.referenceChecksum(sample):
+                print("checksum mismatch for %d byte payload %s" % (len(sample), sample[:16].hex()))
+                return False
+
+        for sequence_number in range(0x10000):
+            packet = self.buildEchoRequest(0x1234, sequence_number)
+            if self.referenceChecksum(packet) != 0:
+                print("echo request with sequence number %d has a bad checksum" % (sequence_number))
+                return False
+        return True
+
+    def timeCall(self, function, data, iterations):
+        start = time()
+        for i in range(iterations):
+            function(data)
+        return (time() - start) / iterations
+
+    def __init__(self, args):
+        print("Checksum benchmark...")
+        if not self.verify(args.sizes):
+            sys.exit(1)
+        print("checksum matches referenceChecksum")
+
+        # Iterations shrink with the payload size so every size takes a similar amount of time
+        print("%10s %14s %14s %10s %12s" % ("bytes", "reference us", "checksum us", "speedup", "MB/s"))
+        for size in args.sizes:
+            data = os.urandom(size)
+            iterations = max(10, args.iterations * 40 // max(size, 40))
+            reference = self.timeCall(self.referenceChecksum, data, max(1, iterations // 20))
+            fast = self.timeCall(self.checksum, data, iterations)
+            print("%10d %14.2f %14.2f %9.1fx %12.1f" % (size, reference * 1e6, fast * 1e6, reference / fast, size / fast / 1e6))
+
+        # A full echo request with the cached partial sum, as sent by ping and traceroute
+        iterations = args.iterations
+        start = time()
+        for sequence_number in range(iterations):
+            self.buildEchoRequest(0x1234, sequence_number & 0xffff)
+        print("buildEchoRequest: %.2f us per packet" % ((time() - start) / iterations * 1e6))
+
+
+class HttpBenchmark(NetworkApplication):
+    # Load generator for the web and proxy subcommands. The server runs in this process on background threads
+    # (the proxy with a web server as its stand-in origin), so clients and server share one interpreter and the
+    # numbers are meant for comparing runs with each other rather than as absolute capacity.
+    # A request hits the cache with the configured probability by asking for the hot file, otherwise it asks
+    # for something the cache cannot hold: one of cold_files files cycled through a web cache sized for half
+    # of them, or a URL the proxy has never seen.
+    cold_files = 64
+
+    def freePort(self):
+        probe_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe_socket.bind(("localhost", 0))
+        port = probe_socket.getsockname()[1]
+        probe_socket.close()
+        return port
+
+    def startServer(self, application, serverArgs):
+        threading.Thread(target=application, args=(serverArgs,), daemon=True).start()
+        deadline = time() + 10
         while True:
-            client_socket, address = proxy_socket.accept() # socket.accept() returns a tuple containing the connection socket and the connection address
-            print(f"Received connection from {address}")
+            try:
+                socket.create_connection(("localhost", serverArgs.port), timeout=1).close()
+                return
+            except OSError:
+                if time() > deadline:
+                    raise
+                sleep(0.05)
+
+    def webServerArgs(self, args, root, cacheBytes):
+        return argparse.Namespace(port=self.freePort(), root=root, concurrency=args.concurrency, threads=args.threads,
+                                  backlog=1024, keep_alive_timeout=30, max_requests=1000000,
+                                  cache_size=cacheBytes / (1024 * 1024), log_level="off", access_log=None,
+                                  workers=1, reuse_port=True, metrics_port=None, index=False, index_refresh=5)
+
+    def createFiles(self, directory, size):
+        # Files are dated a day back so the proxy cache considers them fresh for a while (10% of their age)
+        day_ago = time() - 86400
+        names = ["hot-%d.bin" % (size)] + ["cold-%d-%d.bin" % (size, number) for number in range(self.cold_files)]
+        for name in names:
+            path = os.path.join(directory, name)
+            with open(path, "wb") as benchFile:
+                benchFile.write(os.urandom(size))
+            os.utime(path, (day_ago, day_ago))
+        return names
+
+    def startTarget(self, args, directory, size):
+        # Starts the server under test for one file size, returns [port, url prefix of the requested paths]
+        if args.target == "web":
+            server_args = self.webServerArgs(args, directory, size * self.cold_files / 2)
+            self.startServer(WebServer, server_args)
+            return [server_args.port, ""]
+
+        origin_args = self.webServerArgs(args, directory, 0)
+        self.startServer(WebServer, origin_args)
+        proxy_args = argparse.Namespace(port=self.freePort(), threads=args.threads, backlog=1024, timeout=10,
+                                        cache_dir=os.path.join(directory, "proxy_cache-%d" % (size)), cache_disk=4096,
+                                        cache_memory=256, cache_report_interval=0, pool_size=args.clients,
+                                        pool_idle_timeout=30, dns_ttl=60, log_level="off", access_log=None,
+                                        workers=1, reuse_port=True, metrics_port=None)
+        self.startServer(Proxy, proxy_args)
+        return [proxy_args.port, "http://localhost:%d" % (origin_args.port)]
+
+    def startInterimOrigin(self):
+        # Origin for checkInterimResponses, it sends 100 Continue after every request header whether or not the
+        # client asked for it, then reads the body and answers with the method and body length it got
+        listener = socket.create_server(("localhost", 0))
+
+        def serveConnection(connection):
+            buffer = bytearray()
+            progress = {}
+            with connection:
+                while True:
+                    request = self.takeRequest(buffer, progress, withBody=False)
+                    if request is None:
+                        data = connection.recv(65536)
+                        if not data:
+                            return
+                        buffer += data
+                        continue
+                    connection.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    while len(buffer) < request["length"]:
+                        data = connection.recv(65536)
+                        if not data:
+                            return
+                        buffer += data
+                    del buffer[:request["length"]]
+                    body = ("%s %d" % (request["method"], request["length"])).encode()
+                    connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+
+        def acceptConnections():
+            while True:
+                threading.Thread(target=serveConnection, args=(listener.accept()[0],), daemon=True).start()
+
+        threading.Thread(target=acceptConnections, daemon=True).start()
+        return listener.getsockname()[1]
+
+    def checkInterimResponses(self, proxyPort):
+        # Regression check run before the proxy is loaded: an upload sent with Expect: 100-continue must get
+        # the proxy's 100 Continue and then the origin's final response, and the next request over the pooled
+        # origin connection must get its own response rather than anything left over from the upload
+        origin = "localhost:%d" % (self.startInterimOrigin())
+        body = os.urandom(2048)
+        try:
+            with socket.create_connection(("localhost", proxyPort), timeout=5) as connection:
+                connection.sendall(("POST http://%s/upload HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n"
+                                    "Expect: 100-continue\r\n\r\n" % (origin, origin, len(body))).encode())
+                interim = b""
+                while b"\r\n\r\n" not in interim:
+                    data = connection.recv(65536)
+                    if not data:
+                        break
+                    interim += data
+                if not interim.startswith(b"HTTP/1.1 100 "):
+                    print("the proxy did not answer Expect: 100-continue, got %r" % (interim[:40]))
+                    return False
+                connection.sendall(body)
+                for method, expected in (("POST", b"POST 2048"), ("GET", b"GET 0")):
+                    if method == "GET":
+                        connection = socket.create_connection(("localhost", proxyPort), timeout=5)
+                        connection.sendall(("GET http://%s/next HTTP/1.1\r\nHost: %s\r\n\r\n" % (origin, origin)).encode())
+                    response = interim.partition(b"\r\n\r\n")[2] if method == "POST" else b""
+                    with connection:
+                        while True:
+                            data = connection.recv(65536)
+                            if not data:
+                                break
+                            response += data
+                    if not response.startswith(b"HTTP/1.1 200 ") or not response.endswith(b"\r\n\r\n" + expected):
+                        print("the proxy answered a %s after an interim response with %r" % (method, response[:80]))
+                        return False
+        except OSError as error:
+            print("interim response check failed: %s" % (error))
+            return False
+        return True
+
+    def readResponse(self, connection, view):
+        # Reads one response into the scratch buffer, returns [bytes received, whether the connection stays open]
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = connection.recv(65536)
+            if not chunk:
+                raise ConnectionError("server closed the connection before responding")
+            data += chunk
+        header_end = data.index(b"\r\n\r\n") + 4
+        status, headers = self.parseResponseHeader(data[:header_end])
+        if status != 200:
+            raise ConnectionError("unexpected status %d" % (status))
+
+        received = len(data) - header_end
+        length = int(headers.get("content-length", -1))
+        while length < 0 or received < length:
+            count = connection.recv_into(view)
+            if count == 0:
+                if length < 0:
+                    return [header_end + received, False]
+                raise ConnectionError("server closed the connection in the middle of the body")
+            received += count
+        return [header_end + received, "close" not in headers.get("connection", "").lower()]
+
+    def runClient(self, port, prefix, names, hitRatio, keepAlive, deadline, seed, results):
+        random_source = random.Random(seed)
+        view = memoryview(bytearray(65536))
+        latencies = []
+        transferred = 0
+        errors = 0
+        connection = None
+        counter = 0
+        while time() < deadline:
+            # 1. Pick the hot file or a request that misses the cache
+            counter += 1
+            if random_source.random() < hitRatio:
+                path = "/" + names[0]
+            elif prefix:
+                path = "/%s?client=%d&n=%d" % (names[1 + counter % self.cold_files], seed, counter)
+            else:
+                path = "/" + names[1 + (seed + counter) % self.cold_files]
+            request = ("GET %s%s HTTP/1.1\r\nHost: localhost:%d\r\nConnection: %s\r\n\r\n"
+                       % (prefix, path, port, "keep-alive" if keepAlive else "close")).encode()
+
+            # 2. Time the request, a fresh connection is part of the latency when keep-alive is off
+            start = time()
+            try:
+                if connection is None:
+                    connection = socket.create_connection(("localhost", port), timeout=30)
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                connection.sendall(request)
+                size, stays_open = self.readResponse(connection, view)
+                latencies.append(time() - start)
+                transferred += size
+                if not (keepAlive and stays_open):
+                    connection.close()
+                    connection = None
+            except (OSError, ValueError):
+                errors += 1
+                if connection is not None:
+                    connection.close()
+                    connection = None
+        if connection is not None:
+            connection.close()
+        results.append([latencies, transferred, errors])
+
+    def runScenario(self, args, port, prefix, names, size, hitRatio):
+        # Warm the caches with the hot file, then let every client loop until the duration is up
+        self.runClient(port, prefix, names, 1.0, False, time(), 0, [])
+        results = []
+        deadline = time() + args.duration
+        start = time()
+        clients = [threading.Thread(target=self.runClient, args=(port, prefix, names, hitRatio, not args.fresh_connections,
+                                                                 deadline, number + 1, results))
+                   for number in range(args.clients)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time() - start
+
+        latencies = sorted(latency for result in results for latency in result[0])
+        transferred = sum(result[1] for result in results)
+        return {"target": args.target, "size": size, "hit_ratio": hitRatio, "clients": args.clients,
+                "keep_alive": not args.fresh_connections, "duration": elapsed, "requests": len(latencies),
+                "errors": sum(result[2] for result in results), "requests_per_second": len(latencies) / elapsed,
+                "bytes_per_second": transferred / elapsed,
+                "latency_ms": {"mean": 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+                               "p50": 1000 * self.percentile(latencies, 0.50), "p95": 1000 * self.percentile(latencies, 0.95),
+                               "p99": 1000 * self.percentile(latencies, 0.99), "max": 1000 * (latencies[-1] if latencies else 0.0)}}
+
+    def __init__(self, args):
+        print("Benchmarking %s with %d %s clients for %.1f s per scenario..."
+              % (args.target, args.clients, "fresh connection" if args.fresh_connections else "keep-alive", args.duration))
+        print("%-6s %10s %6s %9s %7s %10s %10s %9s %9s %9s" % ("target", "bytes", "hit%", "requests", "errors",
+                                                               "req/s", "MB/s", "p50 ms", "p95 ms", "p99 ms"))
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            for size in args.sizes:
+                names = self.createFiles(directory, size)
+                # The servers under test run with logging off, only their start up lines are dropped
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    port, prefix = self.startTarget(args, directory, size)
+                if args.target == "proxy" and not self.checkInterimResponses(port):
+                    sys.exit(1)
+                for hit_ratio in args.hit_ratios:
+                    result = self.runScenario(args, port, prefix, names, size, hit_ratio)
+                    results.append(result)
+                    print("%-6s %10d %6.0f %9d %7d %10.1f %10.2f %9.3f %9.3f %9.3f"
+                          % (result["target"], size, 100 * hit_ratio, result["requests"], result["errors"],
+                             result["requests_per_second"], result["bytes_per_second"] / 1e6, result["latency_ms"]["p50"],
+                             result["latency_ms"]["p95"], result["latency_ms"]["p99"]))
+
+        if args.json:
+            self.writeReport(args.json, results)
+
+
+class StartupBenchmark(NetworkApplication):
+    # Times a short job, one ping by default, from starting it to its exit. As a new process started the
+    # usual ways and through the daemon, against an interpreter that does nothing as the floor.
+    default_job = ['ping', '127.0.0.1', '--count', '1', '--timeout', '1']
+
+    def timeRuns(self, command, runs, environment):
+        durations = []
+        for run in range(runs):
+            start = time()
+            completed = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment)
+            durations.append(time() - start)
+            if completed.returncode != 0:
+                print("%s exited with status %d" % (" ".join(command), completed.returncode))
+                sys.exit(1)
+        return sorted(durations)
+
+    def timeJobs(self, socketPath, job, runs):
+        # The request sent straight from this process, the time left is the daemon forking and running the job
+        durations = []
+        with open(os.devnull, "wb") as devnull:
+            for run in range(runs):
+                start = time()
+                status = JobClient.runJob(socketPath, job, devnull)
+                durations.append(time() - start)
+                if status != 0:
+                    print("the daemon job exited with status %d" % (status))
+                    sys.exit(1)
+        return sorted(durations)
+
+    def startDaemon(self, script, socketPath):
+        daemon = subprocess.Popen([sys.executable, script, "daemon", "--socket", socketPath], stdout=subprocess.DEVNULL)
+        deadline = time() + 10
+        while not os.path.exists(socketPath):
+            if daemon.poll() is not None or time() > deadline:
+                print("the daemon did not start")
+                sys.exit(1)
+            sleep(0.01)
+        return daemon
+
+    def __init__(self, args):
+        script = os.path.abspath(__file__)
+        directory, module = os.path.split(script)
+        # python -m finds the module through PYTHONPATH and runs its cached bytecode instead of compiling it
+        environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [directory, os.environ.get("PYTHONPATH")])))
+        module = os.path.splitext(module)[0]
+        job = args.job or self.default_job
+        print("Timing %s %d times per way of starting it..." % (" ".join(job), args.runs))
+        print("%-10s %10s %10s %10s" % ("start", "p50 ms", "p95 ms", "max ms"))
 
-            request_info = self.getRequestInfo(client_socket) # request info will contain the server url and the full client request
-            print("Server Info: ", request_info)
-            server_socket = self.createServerScoket(request_info[0])
-            self.sendResponsetoClient(client_socket, self.sendRequestToServer(server_socket, request_info))
+        results = []
+        with tempfile.TemporaryDirectory() as socket_directory:
+            socket_path = os.path.join(socket_directory, "daemon.sock")
+            daemon = self.startDaemon(script, socket_path)
+            try:
+                scenarios = [("python", lambda: self.timeRuns([sys.executable, "-c", "pass"], args.runs, environment)),
+                             ("script", lambda: self.timeRuns([sys.executable, script] + job, args.runs, environment)),
+                             ("module", lambda: self.timeRuns([sys.executable, "-m", module] + job, args.runs, environment)),
+                             ("client", lambda: self.timeRuns([sys.executable, "-m", module, "client", "--socket", socket_path] + job,
+                                                              args.runs, environment)),
+                             ("daemon", lambda: self.timeJobs(socket_path, job, args.runs))]
+                for name, timeScenario in scenarios:
+                    durations = timeScenario()
+                    result = {"start": name, "runs": args.runs,
+                              "ms": {"p50": 1000 * self.percentile(durations, 0.50), "p95": 1000 * self.percentile(durations, 0.95),
+                                     "max": 1000 * durations[-1]}}
+                    results.append(result)
+                    print("%-10s %10.1f %10.1f %10.1f" % (name, result["ms"]["p50"], result["ms"]["p95"], result["ms"]["max"]))
+            finally:
+                daemon.terminate()
+                daemon.wait()
 
-        proxy_socket.close()
+        if args.json:
+            self.writeReport(args.json, results, job=job)
 
 
 if __name__ == "__main__":
-    args = setupArgumentParser()
+    # A client only forwards its arguments to the daemon, so it does not wait for argparse to be imported
+    args = JobClient.quickArguments(sys.argv[1:]) or setupArgumentParser()
     args.func(args)